@@ -4,64 +4,340 @@ sys.meta_path.insert(0, RedirectPackageFinder())
 
 
 from .const import DOMAIN
-from .smartthings.const import CONF_INSTALLED_APP_ID
+from .smartthings.const import (CONF_APP_ID, CONF_INSTALLED_APP_ID, CONF_LOCATION_ID, CONF_REFRESH_TOKEN,
+                                 DATA_MANAGER)
 
 # load const first to get it renamed
-from .const import DOMAIN, DATA_BROKERS
+from .const import (DOMAIN, CONF_DELTA, CONF_MIN_INTERVAL, CONF_OPTIMISTIC, CONF_PASS_STATE_CHANGES, CONF_THROTTLE,
+                    DATA_BROKERS, DATA_HUBS, DATA_THROTTLE_RULES, PLATFORMS, PLATFORM_CAPABILITIES,
+                    REGISTER_RETRY_MAX_DELAY, SIGNAL_HUB_DISCOVERED, SIGNAL_SMARTTHINGS_UPDATE,
+                    SUBSCRIPTIONS_UPDATE_DELAY)
+from . import smartthings as proxy
 from .smartthings import (async_setup as origin_async_setup,
                           async_setup_entry as origin_async_setup_entry,
                           async_remove_entry as origin_async_remove_entry,
                           async_unload_entry as origin_async_unload_entry,
                           async_migrate_entry as origin_async_migrate_entry,
                           )
-from .smartthings import DeviceBroker
-from pysmartthings import DeviceEntity
-from .hub import Hub
-from homeassistant.config_entries import ConfigEntry
-from homeassistant.core import HomeAssistant
+from .smartthings import DeviceBroker, async_get_entry_scenes
+from .smartthings.smartapp import setup_smartapp, smartapp_sync_subscriptions, validate_installed_app
+from aiohttp.client_exceptions import ClientConnectionError, ClientResponseError
+from pysmartthings import DeviceEntity, SceneEntity, SmartThings
+from .hub import Hub, HubRegistry
+from .retry import HubError, HubUnavailable, backoff_delay
+from .snapshot import DeviceSnapshot, same_devices, status_as_dict
+from .subscriptions import consumed_attributes
+from .throttle import ThrottleRule, default_rules
+from homeassistant.config_entries import SOURCE_IMPORT, ConfigEntry
+from homeassistant.const import (CONF_ACCESS_TOKEN, CONF_ATTRIBUTE, CONF_CLIENT_ID, CONF_CLIENT_SECRET, CONF_DEVICE_ID,
+                                 HTTP_FORBIDDEN, HTTP_UNAUTHORIZED)
+from homeassistant.core import HomeAssistant, callback
+from homeassistant.helpers.aiohttp_client import async_get_clientsession
+from homeassistant.helpers.dispatcher import async_dispatcher_connect, async_dispatcher_send
+from homeassistant.helpers.entity_registry import EVENT_ENTITY_REGISTRY_UPDATED
+from homeassistant.helpers.event import async_call_later
+import homeassistant.helpers.config_validation as cv
+import voluptuous as vol
+from typing import Any, Iterable, List, Tuple
+import asyncio
+import importlib
 import logging
+import time
 
 _LOGGER = logging.getLogger(__name__)
+_cloud_command = DeviceEntity.command
 
+THROTTLE_SCHEMA = vol.Schema({
+    vol.Required(CONF_ATTRIBUTE): cv.string,
+    vol.Optional(CONF_DEVICE_ID): cv.string,
+    vol.Optional(CONF_MIN_INTERVAL, default=0.0): vol.All(vol.Coerce(float), vol.Range(min=0)),
+    vol.Optional(CONF_DELTA): vol.All(vol.Coerce(float), vol.Range(min=0)),
+    vol.Optional(CONF_PASS_STATE_CHANGES, default=False): cv.boolean,
+})
 
-def command(hub: Hub):
-    async def wrapper(self: DeviceEntity, _component_id: str, _capability, command, args=None) -> bool:
+CONFIG_SCHEMA = vol.Schema({
+    DOMAIN: vol.Schema({
+        vol.Optional(CONF_THROTTLE, default=[]): vol.All(cv.ensure_list, [THROTTLE_SCHEMA]),
+    }),
+}, extra=vol.ALLOW_EXTRA)
+
+
+def command(registry: HubRegistry):
+    async def wrapper(self: DeviceEntity, component_id: str, capability, command, args=None) -> bool:
         """Execute a command on the device."""
-        await hub.execute_command(self.device_id, command, args)
+        hub = registry.hub_for_device(self.device_id)
+        if not hub or not hub.lan_ready:
+            return await _cloud_command(self, component_id, capability, command, args)
+        try:
+            await hub.execute_command(self.device_id, command, args)
+        except HubUnavailable as exc:
+            # the hub did not answer or is known to be down
+            _LOGGER.debug("Hub unavailable for %s to %s, sending through cloud: %s", command, self.device_id, exc)
+            return await _cloud_command(self, component_id, capability, command, args)
+        except HubError as exc:
+            _LOGGER.warning("Command %s to %s failed: %s", command, self.device_id, exc)
+            return False
         return True
 
     return wrapper
 
 
-def sm_found(discovery_info):
-    _LOGGER.debug(discovery_info)
+def _assign_capabilities(self: DeviceBroker, devices: Iterable):
+    """Assign platforms to capabilities, importing only candidate platforms."""
+    assignments = {}
+    for device in devices:
+        capabilities = device.capabilities.copy()
+        present = set(capabilities)
+        slots = {}
+        for platform_name in PLATFORMS:
+            wanted = PLATFORM_CAPABILITIES.get(platform_name)
+            if wanted is not None and wanted.isdisjoint(present):
+                continue
+            platform = importlib.import_module(f".{platform_name}", self.__module__)
+            if not hasattr(platform, "get_capabilities"):
+                continue
+            assigned = platform.get_capabilities(capabilities)
+            if not assigned:
+                continue
+            # Draw-down capabilities and set slot assignment
+            for capability in assigned:
+                if capability not in capabilities:
+                    continue
+                capabilities.remove(capability)
+                slots[capability] = platform_name
+        assignments[device.device_id] = slots
+    return assignments
+
+
+def _entry_platforms(broker: DeviceBroker) -> List[str]:
+    used = {platform for slots in broker._assignments.values() for platform in slots.values()}
+    if broker.scenes:
+        used.add("scene")
+    used.add("sensor")  # the LAN diagnostics sensor
+    return [platform for platform in PLATFORMS if platform in used]
+
+
+# platforms are forwarded per entry from the broker's assignments
+proxy.PLATFORMS = []
+DeviceBroker._assign_capabilities = _assign_capabilities
 
 
 async def async_setup(hass, config):
-    #async_dispatcher_connect(hass, "smarthings_hub_found", sm_found)
+    @callback
+    def hub_discovered(hub_ip: str, mac: str):
+        registry = hass.data.get(DOMAIN, {}).get(DATA_HUBS)
+        hub = registry.hub_for_mac(mac, hub_ip) if registry else None
+        if hub:
+            hass.async_create_task(hub.move_to(hub_ip, mac=mac))
+
+    async_dispatcher_connect(hass, SIGNAL_HUB_DISCOVERED, hub_discovered)
+    # kept outside hass.data[DOMAIN], the original setup creates that
+    rules = default_rules()
+    for rule in config.get(DOMAIN, {}).get(CONF_THROTTLE, []):
+        rules[(rule.get(CONF_DEVICE_ID), rule[CONF_ATTRIBUTE])] = ThrottleRule(
+            rule[CONF_MIN_INTERVAL], rule.get(CONF_DELTA), rule[CONF_PASS_STATE_CHANGES])
+    hass.data[DATA_THROTTLE_RULES] = rules
     return await origin_async_setup(hass, config)
 
 
+def _get_registry(hass: HomeAssistant) -> HubRegistry:
+    domain_data = hass.data[DOMAIN]
+    registry = domain_data.get(DATA_HUBS)
+    if registry is None:
+        registry = domain_data[DATA_HUBS] = HubRegistry()
+        DeviceEntity.command = command(registry)
+    return registry
+
+
+def _route_cloud_events(broker: DeviceBroker, hubs: List[Hub]):
+    '''route cloud events through the hub so they are de-duplicated against LAN'''
+    if hubs and broker._event_disconnect:
+        broker._event_disconnect()
+        broker._event_disconnect = broker._smart_app.connect_event(hubs[0].cloud_event_handler)
+
+
+async def _async_warm_start(hass: HomeAssistant, entry: ConfigEntry, snapshot: DeviceSnapshot) -> bool:
+    '''Create the broker from the snapshot, without asking the cloud'''
+    api = SmartThings(async_get_clientsession(hass), entry.data[CONF_ACCESS_TOKEN])
+    cached = await snapshot.load(api)
+    if not cached:
+        return False
+    devices, scenes = cached
+    # token and SmartApp come with the cloud refresh, which connects the broker
+    hass.data[DOMAIN][DATA_BROKERS][entry.entry_id] = DeviceBroker(hass, entry, None, None, devices, scenes)
+    return True
+
+
+async def _async_fetch_cloud(hass: HomeAssistant, entry: ConfigEntry,
+                             api: SmartThings) -> Tuple[Any, Any, List[DeviceEntity], List[SceneEntity]]:
+    '''The cloud requests of the original setup'''
+    smart_app = hass.data[DOMAIN][DATA_MANAGER].smartapps.get(entry.data[CONF_APP_ID])
+    if not smart_app:
+        app = await api.app(entry.data[CONF_APP_ID])
+        smart_app = setup_smartapp(hass, app)
+    installed_app = await validate_installed_app(api, entry.data[CONF_INSTALLED_APP_ID])
+    scenes = await async_get_entry_scenes(entry, api)
+    token = await api.generate_tokens(
+        entry.data[CONF_CLIENT_ID], entry.data[CONF_CLIENT_SECRET], entry.data[CONF_REFRESH_TOKEN])
+    hass.config_entries.async_update_entry(entry, data={**entry.data, CONF_REFRESH_TOKEN: token.refresh_token})
+    devices = await api.devices(location_ids=[installed_app.location_id])
+
+    async def retrieve_device_status(device: DeviceEntity):
+        try:
+            await device.status.refresh()
+        except ClientResponseError:
+            _LOGGER.debug("Unable to update status for device: %s (%s), the device will be excluded",
+                          device.label, device.device_id, exc_info=True)
+            devices.remove(device)
+
+    await asyncio.gather(*(retrieve_device_status(device) for device in devices.copy()))
+    await smartapp_sync_subscriptions(hass, token.access_token, installed_app.location_id,
+                                      installed_app.installed_app_id, devices)
+    return smart_app, token, devices, scenes
+
+
+@callback
+def _remove_and_reauth(hass: HomeAssistant, entry: ConfigEntry):
+    '''What the original setup does when the token is no longer authorized'''
+    hass.async_create_task(hass.config_entries.async_remove(entry.entry_id))
+    # only create new flow if there isn't a pending one for SmartThings.
+    flows = hass.config_entries.flow.async_progress()
+    if not [flow for flow in flows if flow["handler"] == DOMAIN]:
+        hass.async_create_task(
+            hass.config_entries.flow.async_init(DOMAIN, context={"source": SOURCE_IMPORT}))
+
+
+async def _async_refresh_from_cloud(hass: HomeAssistant, entry: ConfigEntry, broker: DeviceBroker,
+                                    snapshot: DeviceSnapshot, hubs: List[Hub]):
+    '''Bring a warm started broker up to date and connect it to the cloud'''
+    api = SmartThings(async_get_clientsession(hass), entry.data[CONF_ACCESS_TOKEN])
+    attempt = 0
+    while True:
+        try:
+            smart_app, token, devices, scenes = await _async_fetch_cloud(hass, entry, api)
+            break
+        except ClientResponseError as exc:
+            if exc.status in (HTTP_UNAUTHORIZED, HTTP_FORBIDDEN):
+                _LOGGER.exception("Unable to refresh configuration entry '%s' - please reconfigure the integration",
+                                  entry.title)
+                _remove_and_reauth(hass, entry)
+                return
+            error: Exception = exc
+        except (ClientConnectionError, asyncio.TimeoutError, RuntimeWarning) as exc:
+            error = exc
+        attempt += 1
+        delay = backoff_delay(attempt, max_delay=REGISTER_RETRY_MAX_DELAY)
+        _LOGGER.warning("Failed to refresh %s from SmartThings, retrying in %.0fs: %s",
+                        entry.title, delay, error or type(error).__name__)
+        await asyncio.sleep(delay)
+    for device in devices:
+        current = broker.devices.get(device.device_id)
+        if current:
+            current.status.apply_data(status_as_dict(device))
+    broker._token = token
+    broker._smart_app = smart_app
+    broker.connect()
+    _route_cloud_events(broker, hubs)
+    async_dispatcher_send(hass, SIGNAL_SMARTTHINGS_UPDATE, set(broker.devices))
+    if same_devices(broker.devices.values(), devices) and \
+            {scene.scene_id for scene in scenes} == set(broker.scenes):
+        await snapshot.save(broker.devices.values(), broker.scenes.values())
+        return
+    _LOGGER.info("Devices of %s changed since the snapshot, reloading", entry.title)
+    await snapshot.save(devices, scenes)
+    hass.async_create_task(hass.config_entries.async_reload(entry.entry_id))
+
+
+def _track_subscriptions(hass: HomeAssistant, entry: ConfigEntry, broker: DeviceBroker, hubs: List[Hub]):
+    '''Re-register when entities are enabled, disabled or removed'''
+    cancel_update = None
+
+    @callback
+    def update_subscriptions(now):
+        nonlocal cancel_update
+        cancel_update = None
+        subscriptions = consumed_attributes(hass, entry, broker)
+        for hub in hubs:
+            hub.set_subscriptions(subscriptions)
+
+    @callback
+    def registry_updated(event):
+        nonlocal cancel_update
+        if cancel_update:
+            cancel_update()
+        cancel_update = async_call_later(hass, SUBSCRIPTIONS_UPDATE_DELAY, update_subscriptions)
+
+    @callback
+    def stop_tracking():
+        if cancel_update:
+            cancel_update()
+
+    entry.async_on_unload(hass.bus.async_listen(EVENT_ENTITY_REGISTRY_UPDATED, registry_updated))
+    entry.async_on_unload(stop_tracking)
+
+
 async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
-    return_value = await origin_async_setup_entry(hass, entry)
+    started = time.monotonic()
+    location_id = entry.data[CONF_LOCATION_ID]
+    snapshot = DeviceSnapshot(hass, location_id)
+    warm = await _async_warm_start(hass, entry, snapshot)
+    if not warm:
+        return_value = await origin_async_setup_entry(hass, entry)
+        if not return_value:
+            return return_value
     broker: DeviceBroker = hass.data[DOMAIN][DATA_BROKERS][entry.entry_id]
-    hub = await Hub.load(hass=hass)
-    DeviceEntity.command = command(hub)
-    setattr(broker, "_hub", hub)
-    hub.start(lambda x: broker._event_handler(x, None, None), entry.data[CONF_INSTALLED_APP_ID])
-    return return_value
+    if not warm:
+        await snapshot.save(broker.devices.values(), broker.scenes.values())
+    platforms = _entry_platforms(broker)
+    hass.config_entries.async_setup_platforms(entry, platforms)
+    registry = _get_registry(hass)
+    hubs = await Hub.load_all(hass=hass, location_id=location_id)
+    for hub in hubs:
+        hub.start(broker, entry.data[CONF_INSTALLED_APP_ID], registry)
+        hub.set_optimistic(entry.options.get(CONF_OPTIMISTIC, False))
+        hub.set_throttle_rules(hass.data.get(DATA_THROTTLE_RULES) or default_rules())
+        hub.set_subscriptions(consumed_attributes(hass, entry, broker))
+    registry.add(entry.entry_id, location_id, broker, hubs)
+    entry.async_on_unload(entry.add_update_listener(async_options_updated))
+    _route_cloud_events(broker, hubs)
+
+    @callback
+    def devices_updated(device_ids):
+        snapshot.schedule_save(broker)
+
+    entry.async_on_unload(async_dispatcher_connect(hass, SIGNAL_SMARTTHINGS_UPDATE, devices_updated))
+    if hubs:
+        _track_subscriptions(hass, entry, broker, hubs)
+    if warm:
+        refresh = asyncio.create_task(_async_refresh_from_cloud(hass, entry, broker, snapshot, hubs))
+        entry.async_on_unload(refresh.cancel)
+    _LOGGER.info("Set up %s from %s with %d hub(s) and platforms %s in %.2fs",
+                 entry.title, "snapshot" if warm else "cloud", len(hubs), ", ".join(platforms),
+                 time.monotonic() - started)
+    return True
+
+
+async def async_options_updated(hass: HomeAssistant, entry: ConfigEntry) -> None:
+    registry: HubRegistry = hass.data[DOMAIN].get(DATA_HUBS)
+    if registry:
+        for hub in registry.hubs(entry.entry_id):
+            hub.set_optimistic(entry.options.get(CONF_OPTIMISTIC, False))
 
 
 async def async_remove_entry(hass: HomeAssistant, entry: ConfigEntry) -> None:
+    await DeviceSnapshot(hass, entry.data[CONF_LOCATION_ID]).remove()
     return await origin_async_remove_entry(hass, entry)
 
 
 async def async_unload_entry(hass: HomeAssistant, entry: ConfigEntry):
-    broker: DeviceBroker = hass.data[DOMAIN][DATA_BROKERS][entry.entry_id]
-    hub: Hub = getattr(broker, "_hub", None)
-    if hub:
-        await hub.stop()
-    return await origin_async_unload_entry(hass, entry)
+    registry: HubRegistry = hass.data[DOMAIN].get(DATA_HUBS)
+    if registry:
+        for hub in registry.remove(entry.entry_id):
+            await hub.stop()
+    broker: DeviceBroker = hass.data[DOMAIN][DATA_BROKERS].get(entry.entry_id)
+    platforms = _entry_platforms(broker) if broker else []
+    unloaded = await hass.config_entries.async_unload_platforms(entry, platforms)
+    return await origin_async_unload_entry(hass, entry) and unloaded
 
 
 async def async_migrate_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
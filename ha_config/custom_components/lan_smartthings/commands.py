@@ -0,0 +1,205 @@
+"""Queue commands sent to the hub."""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Mapping, Optional, Set, Tuple
+from uuid import uuid4
+
+from .const import COMMAND_ACK_MAX_PENDING, COMMAND_ACK_TIMEOUT, COMMAND_GROUPS, MAX_COMMANDS_IN_FLIGHT
+from .metrics import HubMetrics
+from .retry import HubError
+
+PostCommands = Callable[[List[Dict[str, Any]]], Awaitable[None]]
+_LOGGER = logging.getLogger(__name__)
+
+
+class _PendingCommand():
+    __slots__ = ("id", "command", "args", "future")
+
+    def __init__(self, command: str, args: Any, future: "asyncio.Future[None]") -> None:
+        self.id = uuid4().hex
+        self.command = command
+        self.args = args
+        self.future = future
+
+
+class CommandQueue():
+    '''Coalesce superseded commands per device and batch them per loop tick.
+
+    Commands are keyed by device and command group (e.g. ``on``/``off`` share
+    the ``switch`` group). Until a command is sent, a newer command for the
+    same key replaces it (last writer wins), moves behind the other commands
+    of the device, and all callers are resolved when the surviving command is
+    sent. A device with commands in flight gets no more until they are
+    posted. Everything queued when a request slot becomes free is posted to
+    the hub as a single batch.
+    '''
+
+    def __init__(self, post: PostCommands, *, max_in_flight: int = MAX_COMMANDS_IN_FLIGHT) -> None:
+        self._post = post
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._pending: Dict[Tuple[str, str], _PendingCommand] = {}
+        self._in_flight: Set[str] = set()  # device ids
+        self._flush_task: Optional["asyncio.Task[None]"] = None
+        self.sent = 0
+        self.batches = 0
+        self.merged = 0
+        self.dropped = 0
+
+    async def submit(self, device_id: str, command: str, args: Any = None) -> str:
+        '''Queue a command, returns its correlation id once it was posted'''
+        key = (device_id, COMMAND_GROUPS.get(command, command))
+        pending = self._pending.pop(key, None)
+        if pending:
+            pending.command = command
+            pending.args = args
+            # the merged command is the device's latest, it goes after the others
+            self._pending[key] = pending
+            self.merged += 1
+        else:
+            pending = _PendingCommand(command, args, asyncio.get_running_loop().create_future())
+            self._pending[key] = pending
+            self._schedule_flush()
+        await asyncio.shield(pending.future)
+        return pending.id
+
+    def _schedule_flush(self):
+        # devices in flight are sent by the flush their post finishes in
+        if self._flush_task is None and any(device_id not in self._in_flight for device_id, _ in self._pending):
+            self._flush_task = asyncio.create_task(self._flush())
+
+    async def _flush(self):
+        await self._semaphore.acquire()
+        self._flush_task = None
+        # devices still in flight wait so commands for one device stay in order
+        batch = [(key, pending) for key, pending in self._pending.items()
+                 if key[0] not in self._in_flight]
+        for key, _ in batch:
+            del self._pending[key]
+            self._in_flight.add(key[0])
+        try:
+            if batch:
+                await self._post([{"id": pending.id, "device_id": key[0],
+                                   "command": pending.command, "args": pending.args}
+                                  for key, pending in batch])
+                self.sent += len(batch)
+                self.batches += 1
+        except Exception as exc:
+            for _, pending in batch:
+                if not pending.future.done():
+                    pending.future.set_exception(exc)
+        else:
+            for _, pending in batch:
+                if not pending.future.done():
+                    pending.future.set_result(None)
+        finally:
+            self._in_flight.difference_update(key[0] for key, _ in batch)
+            self._semaphore.release()
+            self._schedule_flush()
+
+    def close(self):
+        '''Drop all queued commands'''
+        if self._flush_task:
+            self._flush_task.cancel()
+            self._flush_task = None
+        for pending in self._pending.values():
+            if not pending.future.done():
+                pending.future.set_exception(HubError("Hub stopped"))
+        if self._pending:
+            _LOGGER.debug("Dropped %d queued commands", len(self._pending))
+        self.dropped += len(self._pending)
+        self._pending.clear()
+
+
+def _consume(future: "asyncio.Future[None]"):
+    # nobody has to await an ack, do not warn about unretrieved errors
+    if not future.cancelled():
+        future.exception()
+
+
+class _PendingAck():
+    __slots__ = ("future", "sent", "timer")
+
+    def __init__(self, future: "asyncio.Future[None]", sent: float, timer: asyncio.TimerHandle) -> None:
+        self.future = future
+        self.sent = sent
+        self.timer = timer
+
+
+class CommandAcks():
+    '''Commands posted to the hub that it has not acknowledged yet.
+
+    The hub answers every command carrying an ``id`` with an ack holding the
+    same id and whether it succeeded. Unacknowledged commands fail after
+    ``timeout`` seconds, and the oldest one is failed when more than
+    ``max_pending`` are waiting.
+    '''
+
+    def __init__(self, metrics: HubMetrics, *, timeout: float = COMMAND_ACK_TIMEOUT,
+                 max_pending: int = COMMAND_ACK_MAX_PENDING) -> None:
+        self._metrics = metrics
+        self._timeout = timeout
+        self._max_pending = max_pending
+        self._pending: "OrderedDict[str, _PendingAck]" = OrderedDict()
+        self.acked = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.evicted = 0
+
+    def expect(self, command_id: str):
+        pending = self._pending
+        while len(pending) >= self._max_pending:
+            _, oldest = pending.popitem(last=False)
+            self._fail(oldest, HubError("Too many commands awaiting acknowledgement"))
+            self.evicted += 1
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        future.add_done_callback(_consume)
+        timer = loop.call_later(self._timeout, self._expire, command_id)
+        pending[command_id] = _PendingAck(future, time.monotonic(), timer)
+
+    def get(self, command_id: str) -> "Optional[asyncio.Future[None]]":
+        pending = self._pending.get(command_id)
+        return pending.future if pending else None
+
+    def resolve(self, ack: Mapping[str, Any]):
+        pending = self._pending.pop(ack.get("id"), None)
+        if not pending:
+            return  # late or unknown
+        pending.timer.cancel()
+        self._metrics.command_ack.observe(time.monotonic() - pending.sent)
+        if ack.get("ok", True):
+            self.acked += 1
+            if not pending.future.done():
+                pending.future.set_result(None)
+        else:
+            self.failed += 1
+            self._fail(pending, HubError(ack.get("error") or "Command failed on hub"))
+
+    def discard(self, command_ids: Iterable[str], exc: BaseException):
+        '''Stop waiting for commands that never reached the hub'''
+        for command_id in command_ids:
+            pending = self._pending.pop(command_id, None)
+            if pending:
+                self._fail(pending, exc)
+
+    def _expire(self, command_id: str):
+        pending = self._pending.pop(command_id, None)
+        if pending:
+            self.timed_out += 1
+            self._fail(pending, HubError("Command was not acknowledged in time"))
+
+    @staticmethod
+    def _fail(pending: _PendingAck, exc: BaseException):
+        pending.timer.cancel()
+        if not pending.future.done():
+            pending.future.set_exception(exc)
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def close(self):
+        for pending in self._pending.values():
+            self._fail(pending, HubError("Hub stopped"))
+        self._pending.clear()
@@ -1,19 +1,20 @@
 """Config flow to configure SmartThings."""
 from .smartthings.config_flow import SmartThingsFlowHandler
 import os
-from .const import DOMAIN, CONF_APP_ID
+from .const import DOMAIN, CONF_APP_ID, CONF_OPTIMISTIC, SIGNAL_HUB_DISCOVERED
 import logging
 from typing import Any, Callable, Coroutine, Dict, Optional, Protocol, TypeVar
 import voluptuous as vol
 from .const import CONF_LOCATION_ID
 from homeassistant.const import CONF_ACCESS_TOKEN
-from homeassistant.config_entries import HANDLERS
+from homeassistant.config_entries import HANDLERS, ConfigEntry, OptionsFlow
+from homeassistant.core import callback
 from homeassistant.data_entry_flow import FlowResult
 from homeassistant.helpers.aiohttp_client import async_get_clientsession
 from homeassistant.helpers.dispatcher import async_dispatcher_send
 from homeassistant.helpers.typing import DiscoveryInfoType
 import re
-from .hub import Hub
+from .hub import Hub, discovered_hub
 from .smartapp import _SmartApps, classic_smartapps
 
 _LOGGER = logging.getLogger(__name__)
@@ -65,6 +66,11 @@ class LanSmartThingsFlowHandler(SmartThingsFlowHandler, ForwardProtocol):
         self.app_id: Optional[str] = None
         self.servername: Optional[str] = None
 
+    @staticmethod
+    @callback
+    def async_get_options_flow(config_entry: ConfigEntry) -> OptionsFlow:
+        return LanSmartThingsOptionsFlow(config_entry)
+
     @property
     def is_forwarding(self) -> bool:
         return self._is_forwarding
@@ -153,3 +159,27 @@ class LanSmartThingsFlowHandler(SmartThingsFlowHandler, ForwardProtocol):
         async_dispatcher_send(
             self.hass, "smarthings_hub_found", discovery_info)
         return self.async_abort(reason="Hub found")
+
+    async def async_step_dhcp(self, discovery_info: DiscoveryInfoType) -> FlowResult:
+        """Handle a flow initialized by DHCP discovery."""
+        # a hub seen on the network may have moved, the loaded entries follow it
+        hub = discovered_hub(discovery_info)
+        if hub:
+            async_dispatcher_send(self.hass, SIGNAL_HUB_DISCOVERED, *hub)
+        return self.async_abort(reason="Hub found")
+
+
+class LanSmartThingsOptionsFlow(OptionsFlow):
+    def __init__(self, config_entry: ConfigEntry) -> None:
+        self.config_entry = config_entry
+
+    async def async_step_init(self, user_input: Optional[Dict[str, Any]] = None) -> FlowResult:
+        if user_input is not None:
+            return self.async_create_entry(title="", data=user_input)
+        return self.async_show_form(
+            step_id="init",
+            data_schema=vol.Schema({
+                vol.Optional(CONF_OPTIMISTIC,
+                             default=self.config_entry.options.get(CONF_OPTIMISTIC, False)): bool
+            }),
+        )
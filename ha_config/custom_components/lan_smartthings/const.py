@@ -3,17 +3,103 @@
 DOMAIN = "lan_smartthings"
 SIGNAL_SMARTTHINGS_UPDATE = "lan_smartthings_update"
 SIGNAL_SMARTAPP_PREFIX = "lan_smartthings_smartap_"
+SIGNAL_HUB_DISCOVERED = "lan_smartthings_hub_discovered"
 STORAGE_KEY = DOMAIN
 CLASSIC_APP_NAME = "Home Assistant Relay"
 CONF_LAN_CALLBACK_WEBHOOK_ID = "lan_webhook_id"
 CONF_HUB_ACCESS_TOKEN = "hub_access_token"
 CONF_HUB_URL = "hub_url"
 CONF_HUB_IP = "hub_ip"
+CONF_HUB_ID = "hub_id"
+CONF_HUB_MAC = "hub_mac"
+CONF_LAN_HOST = "lan_host"
+CONF_OPTIMISTIC = "optimistic"
+CONF_THROTTLE = "throttle"
+CONF_MIN_INTERVAL = "min_interval"
+CONF_DELTA = "delta"
+CONF_PASS_STATE_CHANGES = "pass_state_changes"
+DATA_THROTTLE_RULES = DOMAIN + "_throttle_rules"
 CONF_CLOUD_CALLBACK_WEBHOOK_ID = "cloud_webhook_id"
 CONF_TARGET_URL_BASE = "target_url_base"
 CONF_TARGET_URL = "target_url"
 CONF_APP_ID = "app_id"
 USER_AGENTv1 = "HA ST Link/1.0"
+DATA_HUBS = "hubs"
+DEDUP_WINDOW = 60.0
+DEDUP_MAX_SIZE = 1024
+EVENT_QUEUE_SIZE = 256
+EVENT_WORKERS = 1
+PATH_LAN = "lan"
+PATH_CLOUD = "cloud"
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+COMMAND_RTT_TIMEOUT = 30.0
+MAX_COMMANDS_IN_FLIGHT = 2
+COMMAND_ACK_TIMEOUT = 10.0
+COMMAND_ACK_MAX_PENDING = 256
+HUB_CONNECTION_LIMIT = 4
+HUB_KEEPALIVE_TIMEOUT = 60.0
+HUB_REQUEST_TIMEOUT = 5.0
+RETRY_MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 8.0
+BREAKER_FAILURE_THRESHOLD = 3
+BREAKER_RESET_TIMEOUT = 30.0
+REGISTER_TIMEOUT = 30.0
+REGISTER_RETRY_MAX_DELAY = 300.0
+HEALTH_CHECK_INTERVAL = 30.0
+HEALTH_PING_TIMEOUT = 5.0
+HEALTH_FAILURE_THRESHOLD = 2
+# cloud forwarding stays paused this long unless renewed by the next health checks
+FORWARD_PAUSE_LEASE = 90.0
+# the SmartApp drops an instance it has not heard from this long, health pings renew it
+SUBSCRIBER_LEASE = 300.0
+CLASSIC_APPS_TTL = 120.0
+SNAPSHOT_SAVE_DELAY = 30.0
+SUBSCRIPTIONS_UPDATE_DELAY = 5.0
+DISCOVERY_PARALLELISM = 4
+COMMAND_GROUPS = {
+    "on": "switch",
+    "off": "switch",
+    "lock": "lock",
+    "unlock": "lock",
+    "open": "openclose",
+    "close": "openclose",
+    "pause": "openclose",
+}
+# command -> (attribute, expected value), None takes the value from args[0]
+OPTIMISTIC_COMMANDS = {
+    "on": ("switch", "on"),
+    "off": ("switch", "off"),
+    "setLevel": ("level", None),
+    "lock": ("lock", "locked"),
+    "unlock": ("lock", "unlocked"),
+}
+OPTIMISTIC_TIMEOUT = 5.0
+# attribute -> default throttling of its LAN reports, see throttle.py
+THROTTLE_RULES = {
+    "power": {CONF_MIN_INTERVAL: 5.0, CONF_DELTA: 1.0},
+    "energy": {CONF_MIN_INTERVAL: 60.0},
+    "voltage": {CONF_MIN_INTERVAL: 30.0, CONF_DELTA: 1.0},
+    "current": {CONF_MIN_INTERVAL: 5.0, CONF_DELTA: 0.1},
+    "rssi": {CONF_MIN_INTERVAL: 300.0, CONF_DELTA: 5.0},
+    "lqi": {CONF_MIN_INTERVAL: 300.0, CONF_DELTA: 10.0},
+}
+# capabilities a device needs for the platform's get_capabilities to claim
+# anything, platforms not listed are always tried
+PLATFORM_CAPABILITIES = {
+    "binary_sensor": frozenset((
+        "accelerationSensor", "contactSensor", "filterStatus", "motionSensor",
+        "presenceSensor", "soundSensor", "tamperAlert", "valve", "waterSensor")),
+    "climate": frozenset((
+        "airConditionerMode", "thermostat", "thermostatCoolingSetpoint",
+        "thermostatHeatingSetpoint", "thermostatMode", "thermostatOperatingState")),
+    "cover": frozenset(("doorControl", "garageDoorControl", "windowShade")),
+    "fan": frozenset(("fanSpeed",)),
+    "light": frozenset(("colorControl", "colorTemperature", "switchLevel")),
+    "lock": frozenset(("lock",)),
+    "scene": frozenset(),  # set up from broker scenes, not device capabilities
+    "switch": frozenset(("switch",)),
+}
 
 import importlib
 proxy = importlib.import_module(".smartthings.const", __package__)
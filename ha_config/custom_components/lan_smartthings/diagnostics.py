@@ -0,0 +1,26 @@
+"""Diagnostics support for SmartThings on LAN.
+
+Home Assistant 2022.2 and later download these from the integration page,
+the diagnostics sensor shows a summary of them as attributes.
+"""
+from typing import Any, Dict
+
+from homeassistant.config_entries import ConfigEntry
+from homeassistant.core import HomeAssistant
+
+from .const import DATA_HUBS, DOMAIN
+from .package_finder import IMPORT_TIMINGS
+
+
+def entry_diagnostics(hass: HomeAssistant, entry: ConfigEntry) -> Dict[str, Any]:
+    registry = hass.data[DOMAIN].get(DATA_HUBS)
+    hubs = registry.hubs(entry.entry_id) if registry else []
+    return {
+        "hubs": {hub.hub_id: hub.diagnostics() for hub in hubs},
+        "import_timings": {name: round(seconds, 4) for name, seconds in IMPORT_TIMINGS.items()},
+    }
+
+
+async def async_get_config_entry_diagnostics(hass: HomeAssistant, entry: ConfigEntry) -> Dict[str, Any]:
+    """Return diagnostics for a config entry."""
+    return entry_diagnostics(hass, entry)
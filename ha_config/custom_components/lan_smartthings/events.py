@@ -0,0 +1,185 @@
+"""Events received from the hub on LAN."""
+import asyncio
+from collections import OrderedDict
+import logging
+import time
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple
+
+from homeassistant.util import dt as dt_util
+from pysmartthings import Attribute
+
+from .const import DEDUP_MAX_SIZE, DEDUP_WINDOW, EVENT_QUEUE_SIZE, EVENT_WORKERS, PATH_LAN
+from .metrics import HubMetrics
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class LanEvent():
+    '''Device event captured on LAN by the SmartApp'''
+    __slots__ = ("event_id", "location_id", "device_id", "attribute", "value", "data", "state_change", "time")
+
+    def __init__(self, json_data: Mapping[str, Any]) -> None:
+        self.event_id: str = json_data["eventId"]
+        self.location_id: str = json_data["locationId"]
+        self.device_id: str = json_data["deviceId"]
+        self.attribute: str = json_data["attribute"]
+        self.value: Any = json_data["value"]
+        self.data: Any = json_data["data"]
+        self.state_change: bool = json_data["stateChange"]
+        # epoch milliseconds of the event on the hub, older SmartApps do not send it
+        self.time: Optional[int] = json_data.get("time")
+
+
+class EventDeduplicator():
+    '''Remember event ids seen on either path for a bounded time window.
+
+    When a copy arrives on the other path, the path that won the race and
+    the lag of the losing copy are recorded in ``metrics``.
+    '''
+
+    def __init__(self, *, window: float = DEDUP_WINDOW, max_size: int = DEDUP_MAX_SIZE,
+                 metrics: Optional[HubMetrics] = None) -> None:
+        self._window = window
+        self._max_size = max_size
+        self._metrics = metrics
+        self._seen: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+    def seen(self, event_id: str, path: str = PATH_LAN) -> bool:
+        '''return True if the event was already seen, else remember it'''
+        now = time.monotonic()
+        self._evict(now)
+        first = self._seen.get(event_id)
+        if first:
+            first_seen, first_path = first
+            metrics = self._metrics
+            if metrics and first_path != path:
+                metrics.race_wins[first_path] += 1
+                metrics.race_lag.observe(now - first_seen)
+            return True
+        self._seen[event_id] = (now, path)
+        if len(self._seen) > self._max_size:
+            self._seen.popitem(last=False)
+        return False
+
+    def _evict(self, now: float):
+        expire_before = now - self._window
+        seen = self._seen
+        while seen:
+            oldest, _ = next(iter(seen.values()))
+            if oldest >= expire_before:
+                break
+            seen.popitem(last=False)
+
+
+def cloud_event_time(raw_event: Mapping[str, Any]) -> Optional[int]:
+    '''epoch milliseconds of an event in a cloud EVENT request, like LAN events carry'''
+    parsed = dt_util.parse_datetime(raw_event.get("eventTime") or "")
+    return int(parsed.timestamp() * 1000) if parsed else None
+
+
+class EventOrder():
+    '''Time of the last event applied for each device attribute.
+
+    Events posted by the hub can overtake each other on the way, and the
+    LAN and cloud copies of different events race each other. An event
+    older than the one last applied for the attribute, on either path, is
+    stale and would only flip the state back. Entries are bounded by the
+    device attribute count.
+    '''
+
+    def __init__(self, *, metrics: Optional[HubMetrics] = None) -> None:
+        self._metrics = metrics
+        self._applied: Dict[Tuple[str, str], int] = {}
+
+    def __len__(self) -> int:
+        return len(self._applied)
+
+    def stale(self, device_id: str, attribute: str, event_time: Optional[int]) -> bool:
+        '''return True if a newer event of the attribute was applied, else remember it'''
+        if event_time is None:
+            return False
+        key = (device_id, attribute)
+        applied = self._applied.get(key)
+        if applied is not None and event_time < applied:
+            if self._metrics:
+                self._metrics.stale_events += 1
+            return True
+        self._applied[key] = event_time
+        return False
+
+    def clear(self):
+        self._applied.clear()
+
+
+class EventQueue():
+    '''Bounded queue handing LAN events from the webhook to worker tasks.
+
+    Events are sharded by device, so events of one device are always
+    handled in order by the same worker. When a shard is full its batches
+    are merged into one, keeping only the latest event of each device
+    attribute; button presses are all kept.
+    '''
+
+    def __init__(self, handler: Callable[[List[LanEvent]], None], *,
+                 workers: int = EVENT_WORKERS, max_size: int = EVENT_QUEUE_SIZE) -> None:
+        self._handler = handler
+        self._queues: List["asyncio.Queue[List[LanEvent]]"] = [asyncio.Queue(max_size) for _ in range(workers)]
+        self._tasks: List["asyncio.Task[None]"] = []
+        self.max_depth = 0
+        self.dropped = 0
+
+    @property
+    def depth(self) -> int:
+        return sum(queue.qsize() for queue in self._queues)
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._work(queue)) for queue in self._queues]
+
+    async def stop(self):
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def put(self, lan_events: List[LanEvent]):
+        queues = self._queues
+        shards: Dict[int, List[LanEvent]] = {}
+        for evt in lan_events:
+            shards.setdefault(hash(evt.device_id) % len(queues), []).append(evt)
+        for index, events in shards.items():
+            queue = queues[index]
+            if queue.full():
+                self._coalesce(queue)
+            queue.put_nowait(events)
+        depth = self.depth
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def _coalesce(self, queue: "asyncio.Queue[List[LanEvent]]"):
+        latest: Dict[Tuple[str, str], LanEvent] = {}
+        count = 0
+        while not queue.empty():
+            for evt in queue.get_nowait():
+                # every press is an event of its own, states replace each other
+                key = (evt.device_id, evt.event_id if evt.attribute == Attribute.button else evt.attribute)
+                latest.pop(key, None)
+                latest[key] = evt
+                count += 1
+            queue.task_done()
+        queue.put_nowait(list(latest.values()))
+        self.dropped += count - len(latest)
+        _LOGGER.warning("LAN event queue is full, dropped %d superseded events", count - len(latest))
+
+    async def _work(self, queue: "asyncio.Queue[List[LanEvent]]"):
+        while True:
+            lan_events = await queue.get()
+            try:
+                self._handler(lan_events)
+            except Exception:
+                _LOGGER.exception("Error handling LAN events")
+            finally:
+                queue.task_done()
@@ -1,25 +1,40 @@
 """SmartApp functionality to receive cloud-push notifications."""
 import asyncio
+import copy
 import logging
 import sys
-from typing import Any, Callable, Coroutine, Dict, Generic, List, Mapping, NamedTuple, Optional, TypeVar, TypedDict, cast
+import time
+from typing import Any, Callable, Coroutine, Dict, FrozenSet, Generic, List, Mapping, NamedTuple, Optional, Tuple, TypeVar, TypedDict, cast
+from urllib.parse import urlsplit
 from uuid import uuid4
 
 from aiohttp import hdrs
-from aiohttp.client import ClientTimeout
+from aiohttp.client import ClientSession, ClientTimeout
+from aiohttp.client_exceptions import ClientConnectionError, ClientError
+from aiohttp.connector import TCPConnector
 from aiohttp.web import Request
 from pysmartthings.app import APP_TYPE_WEBHOOK, CLASSIFICATION_AUTOMATION
+from .commands import CommandAcks, CommandQueue
+from .events import EventDeduplicator, EventOrder, EventQueue, LanEvent, cloud_event_time
+from .metrics import HubMetrics
+from .optimistic import OptimisticUpdates
+from .throttle import EventThrottle, ThrottleRules
+from .retry import BREAKER_OPEN, CircuitBreaker, HubError, HubUnavailable, backoff_delay
 from .smartthings.const import APP_NAME_PREFIX, CONF_CLOUDHOOK_URL, CONF_INSTANCE_ID
 from homeassistant.components.network.util import async_get_source_ip
-from homeassistant.const import CONF_WEBHOOK_ID
-from homeassistant.core import HomeAssistant
+from homeassistant.const import CONF_WEBHOOK_ID, EVENT_HOMEASSISTANT_CLOSE
+from homeassistant.core import CALLBACK_TYPE, Event, HomeAssistant, callback
 from homeassistant.helpers.aiohttp_client import async_get_clientsession
+from homeassistant.helpers.dispatcher import async_dispatcher_send
 from homeassistant.helpers.storage import Store
 from pysmartapp.const import EVENT_TYPE_DEVICE
+from pysmartthings import Attribute
 from pysmartapp.event import EventRequest
 import homeassistant.components.webhook as webhook
-from .const import (CONF_CLOUD_CALLBACK_WEBHOOK_ID, CONF_HUB_ACCESS_TOKEN, CONF_HUB_IP, CONF_HUB_URL, CONF_LAN_CALLBACK_WEBHOOK_ID, CONF_TARGET_URL, CONF_TARGET_URL_BASE, DOMAIN, STORAGE_KEY, STORAGE_VERSION,  # type: ignore
-                    USER_AGENTv1)
+from .const import (CONF_CLOUD_CALLBACK_WEBHOOK_ID, CONF_HUB_ACCESS_TOKEN, CONF_HUB_ID, CONF_HUB_IP, CONF_HUB_MAC, CONF_HUB_URL, CONF_LAN_CALLBACK_WEBHOOK_ID, CONF_LAN_HOST, CONF_LOCATION_ID,  # type: ignore
+                    CONF_TARGET_URL, CONF_TARGET_URL_BASE, COMMAND_RTT_TIMEOUT, DOMAIN, EVENT_BUTTON,
+                    FORWARD_PAUSE_LEASE, HEALTH_CHECK_INTERVAL, HEALTH_FAILURE_THRESHOLD, HEALTH_PING_TIMEOUT, HUB_CONNECTION_LIMIT, OPTIMISTIC_COMMANDS, HUB_KEEPALIVE_TIMEOUT, HUB_REQUEST_TIMEOUT, REGISTER_RETRY_MAX_DELAY, REGISTER_TIMEOUT, RETRY_MAX_ATTEMPTS, PATH_CLOUD, PATH_LAN,
+                    SIGNAL_SMARTTHINGS_UPDATE, STORAGE_KEY, STORAGE_VERSION, SUBSCRIBER_LEASE, USER_AGENTv1)
 
 BrokerHandler = Callable[[EventRequest], Coroutine[Any, Any, None]]
 _LOGGER = logging.getLogger(__name__)
@@ -66,6 +81,24 @@ class _SmartApps(NamedTuple):
     properties: Mapping[str, Mapping[str, str]]
 
 
+def mac_key(mac: str) -> str:
+    '''MAC address without separators in lower case, as DHCP discovery reports it'''
+    return mac.lower().replace(":", "").replace("-", "")
+
+
+def discovered_hub(discovery_info: Mapping[str, Any]) -> Optional[Tuple[str, str]]:
+    '''IP and MAC address of a hub in a DHCP discovery'''
+    hub_ip = discovery_info.get("ip")
+    mac = discovery_info.get("macaddress")
+    if not hub_ip or not mac:
+        return None
+    return hub_ip, mac_key(mac)
+
+
+def _location_storage_key(location_id: str) -> str:
+    return f"{STORAGE_KEY}.{location_id}"
+
+
 class HubInfo():
 
     def __init__(self, *, hass: HomeAssistant,
@@ -75,10 +108,18 @@ class HubInfo():
                  cloud_webhook_id: str,
                  access_token: str,
                  instance_id: str,
+                 hub_id: str = "",
+                 location_id: str = "",
+                 lan_host: Optional[str] = None,
+                 mac: Optional[str] = None,
                  **_):
         self.hass = hass
         self._instance_id = instance_id
+        self._hub_id = hub_id
+        self._location_id = location_id
+        self._lan_host = lan_host
         self._hub_ip = hub_ip
+        self._mac = mac_key(mac) if mac else None
         self._targeturl_base = targeturl_base
         self._hub_url = hub_url
         self._lan_webhook_id = lan_webhook_id
@@ -87,102 +128,464 @@ class HubInfo():
         self._cloud_callback_path = webhook.async_generate_path(
             cloud_webhook_id)
         self._access_token = access_token
-        self._target_url = targeturl_base + access_token
 
-    async def save(self):
-        store = Store(self.hass, STORAGE_VERSION, STORAGE_KEY)
-        local_hub = {
+    @property
+    def _target_url(self) -> str:
+        return self._targeturl_base + self._access_token
+
+    @property
+    def _hub_lookup_url(self) -> str:
+        '''cloud endpoint of the SmartApp returning the hubs' LAN addresses'''
+        return self._targeturl_base.replace("/relay?", "/hubs?", 1) + self._access_token
+
+    def _as_dict(self) -> Dict[str, Any]:
+        return {
             CONF_LAN_CALLBACK_WEBHOOK_ID: self._lan_webhook_id,
             CONF_HUB_ACCESS_TOKEN: self._access_token,
             CONF_CLOUD_CALLBACK_WEBHOOK_ID: self._cloud_webhook_id,
             CONF_HUB_URL: self._hub_url,
             CONF_HUB_IP: self._hub_ip,
+            CONF_HUB_MAC: self._mac,
+            CONF_HUB_ID: self._hub_id,
+            CONF_LOCATION_ID: self._location_id,
+            CONF_LAN_HOST: self._lan_host,
             CONF_TARGET_URL_BASE: self._targeturl_base,
             CONF_INSTANCE_ID: self._instance_id,
-            CONF_WEBHOOK_ID: self._cloud_webhook_id,
-            CONF_CLOUDHOOK_URL: None,
         }
-        await store.async_save(local_hub)
 
     @classmethod
-    async def load(cls, hass: HomeAssistant):
+    def _from_dict(cls, hass: HomeAssistant, local_hub: Mapping[str, Any]) -> "HubInfo":
+        return cls(hass=hass,
+                   lan_webhook_id=local_hub[CONF_LAN_CALLBACK_WEBHOOK_ID],
+                   access_token=local_hub[CONF_HUB_ACCESS_TOKEN],
+                   cloud_webhook_id=local_hub[CONF_CLOUD_CALLBACK_WEBHOOK_ID],
+                   hub_url=local_hub[CONF_HUB_URL],
+                   hub_ip=local_hub[CONF_HUB_IP],
+                   mac=local_hub.get(CONF_HUB_MAC),
+                   hub_id=local_hub.get(CONF_HUB_ID, ""),
+                   location_id=local_hub.get(CONF_LOCATION_ID, ""),
+                   lan_host=local_hub.get(CONF_LAN_HOST),
+                   targeturl_base=local_hub[CONF_TARGET_URL_BASE],
+                   instance_id=local_hub[CONF_INSTANCE_ID],
+                   )
+
+    async def save(self, *, replace: bool = False):
+        '''save the info, with replace as the only hub of the location'''
+        store = Store(self.hass, STORAGE_VERSION, _location_storage_key(self._location_id))
+        local_hubs = {} if replace else await store.async_load() or {}
+        local_hubs[self._hub_id] = self._as_dict()
+        await store.async_save(local_hubs)
+        # the built-in smartapp endpoint reads these, they are shared by all locations
+        store = Store(self.hass, STORAGE_VERSION, STORAGE_KEY)
+        await store.async_save({
+            CONF_INSTANCE_ID: self._instance_id,
+            CONF_WEBHOOK_ID: self._cloud_webhook_id,
+            CONF_CLOUDHOOK_URL: None,
+        })
+
+    @staticmethod
+    async def load_shared(hass: HomeAssistant) -> Mapping[str, Any]:
         store = Store(hass, STORAGE_VERSION, STORAGE_KEY)
-        local_hub = await store.async_load()
-        info = HubInfo(hass=hass,
-                       lan_webhook_id=local_hub[CONF_LAN_CALLBACK_WEBHOOK_ID],
-                       access_token=local_hub[CONF_HUB_ACCESS_TOKEN],
-                       cloud_webhook_id=local_hub[CONF_CLOUD_CALLBACK_WEBHOOK_ID],
-                       hub_url=local_hub[CONF_HUB_URL],
-                       hub_ip=local_hub[CONF_HUB_IP],
-                       targeturl_base=local_hub[CONF_TARGET_URL_BASE],
-                       instance_id=local_hub[CONF_INSTANCE_ID],
-                       )
+        return await store.async_load() or {}
+
+    @classmethod
+    async def load_all(cls, hass: HomeAssistant, location_id: str) -> List["HubInfo"]:
+        '''load the info of all hubs registered for the location'''
+        store = Store(hass, STORAGE_VERSION, _location_storage_key(location_id))
+        local_hubs = await store.async_load()
+        if local_hubs is None:
+            return await cls._migrate(hass, location_id)
+        return [cls._from_dict(hass, local_hub) for local_hub in local_hubs.values()]
+
+    @classmethod
+    async def _migrate(cls, hass: HomeAssistant, location_id: str) -> List["HubInfo"]:
+        '''move the single hub kept by earlier versions to the location owning it'''
+        local_hub = await cls.load_shared(hass)
+        if CONF_LAN_CALLBACK_WEBHOOK_ID not in local_hub:
+            return []
+        # the record does not name its location, earlier versions served a single one
+        locations = {entry.data.get(CONF_LOCATION_ID) for entry in hass.config_entries.async_entries(DOMAIN)}
+        if locations != {location_id}:
+            _LOGGER.warning("Cannot tell the location of the hub set up by an earlier version, "
+                            "set up location %s again to use its hub on LAN", location_id)
+            return []
+        info = cls._from_dict(hass, {**local_hub, CONF_LOCATION_ID: location_id})
+        await info.save()
+        return [info]
+
+
+class HubRegistry():
+    '''Hubs of all loaded config entries, indexed for routing.'''
+
+    def __init__(self) -> None:
+        self._entries: Dict[str, Tuple[str, List["Hub"]]] = {}
+        self._hubs_by_device: Dict[str, "Hub"] = {}
+        self.brokers: Dict[str, Any] = {}  # by location id
+
+    def add(self, entry_id: str, location_id: str, broker: Any, hubs: List["Hub"]):
+        self._entries[entry_id] = (location_id, hubs)
+        self.brokers[location_id] = broker
+        if hubs:
+            # the smartapp of a location runs commands for all its devices
+            self._hubs_by_device.update(dict.fromkeys(broker.devices, hubs[0]))
 
-        return info
+    def remove(self, entry_id: str) -> List["Hub"]:
+        location_id, hubs = self._entries.pop(entry_id, ("", []))
+        broker = self.brokers.pop(location_id, None)
+        if broker:
+            for device_id in broker.devices:
+                self._hubs_by_device.pop(device_id, None)
+        return hubs
+
+    def hubs(self, entry_id: str) -> List["Hub"]:
+        return self._entries.get(entry_id, ("", []))[1]
+
+    def hub_for_device(self, device_id: str) -> Optional["Hub"]:
+        hub = self._hubs_by_device.get(device_id)
+        return hub if hub and hub.serves(device_id) else None
+
+    def hub_for_mac(self, mac: str, hub_ip: str) -> Optional["Hub"]:
+        '''The hub with the MAC address, or one without a known MAC still at hub_ip'''
+        mac = mac_key(mac)
+        unknown = None
+        for _, hubs in self._entries.values():
+            for hub in hubs:
+                if hub.mac == mac:
+                    return hub
+                if hub.mac is None and hub.hub_ip == hub_ip:
+                    unknown = hub
+        return unknown
+
+
+def _create_session(instance_id: str) -> ClientSession:
+    '''Session dedicated to a single hub, keeping a few connections alive'''
+    connector = TCPConnector(limit=HUB_CONNECTION_LIMIT,
+                             keepalive_timeout=HUB_KEEPALIVE_TIMEOUT)
+    # the SmartApp keeps a subscriber per instance and answers the one asking
+    return ClientSession(connector=connector,
+                         timeout=ClientTimeout(total=HUB_REQUEST_TIMEOUT),
+                         headers={hdrs.USER_AGENT: USER_AGENTv1, "Instance": instance_id})
+
+
+_ACTION_HEADERS: Dict[str, Mapping[str, str]] = {}
+
+
+def _action_headers(action: str) -> Mapping[str, str]:
+    headers = _ACTION_HEADERS.get(action)
+    if headers is None:
+        headers = _ACTION_HEADERS[action] = {"Action": action}
+    return headers
 
 
 class Hub():
 
-    def __init__(self, hass: HomeAssistant, *,
-                 lan_host: str, info: HubInfo) -> None:
+    def __init__(self, hass: HomeAssistant, *, info: HubInfo) -> None:
         self.hass = hass
         self._info = info
-        self._lan_host = lan_host
+        self._lan_ready = False
+        self._registration: "Optional[asyncio.Future[Mapping[str, Any]]]" = None
+        self._device_ids: Optional[FrozenSet[str]] = None  # None when the SmartApp does not say
+        self._register_task: "Optional[asyncio.Task[None]]" = None
+        self._health_task: "Optional[asyncio.Task[None]]" = None
+        self._healthy = True
+        self._ping_failures = 0
+        self._pong: "Optional[Tuple[str, asyncio.Future[None]]]" = None
+        self._forwarding_paused_until = 0.0
+        self._session: Optional[ClientSession] = None
+        self._remove_close_listener: Optional[CALLBACK_TYPE] = None
+        self._breaker = CircuitBreaker()
+        self._metrics = HubMetrics()
         self._setup_done: bool = False
-        self._last_event_id: Optional[str] = None
+        self._seen_events = EventDeduplicator(metrics=self._metrics)
+        self._event_order = EventOrder(metrics=self._metrics)
+        self._command_sent: Dict[Tuple[str, str], float] = {}  # by device and attribute
+        self._event_queue = EventQueue(self._dispatch)
+        self._throttle = EventThrottle(self._event_queue.put)
+        self._commands = CommandQueue(self._send_commands)
+        self._acks = CommandAcks(self._metrics)
+        self._broker: Any = None
+        self._registry: Optional[HubRegistry] = None
         self._broker_event_handler: Optional[BrokerHandler] = None
         self._installed_app_id: Optional[str] = None
+        self._optimistic: Optional[OptimisticUpdates] = None
+        self._subscriptions: Optional[Dict[str, List[str]]] = None
 
-    def start(self, handler: BrokerHandler, installed_app_id: str):
+    def start(self, broker: Any, installed_app_id: str, registry: HubRegistry):
         info = self._info
         if self._broker_event_handler:
             # skip because already started
             return
-        self._broker_event_handler = handler
+        self._broker = broker
+        self._registry = registry
+        self._broker_event_handler = lambda req: broker._event_handler(req, None, None)
         self._installed_app_id = installed_app_id
+        self._event_queue.start()
         webhook.async_register(self.hass, DOMAIN, "SmartApp",
                                info._lan_webhook_id, self.webhook_handler)
+        # the hub keeps posting to us with the cached registration, commands
+        # go to cloud until it confirms the LAN link
+        self._register_task = asyncio.create_task(self._register_in_background())
+        self._health_task = asyncio.create_task(self._monitor_health())
 
     async def stop(self):
         webhook.async_unregister(self.hass, self._info._lan_webhook_id)
+        if self._register_task:
+            self._register_task.cancel()
+            self._register_task = None
+        if self._health_task:
+            self._health_task.cancel()
+            self._health_task = None
+        self._forwarding_paused_until = 0.0  # unregister resumes it
+        self._lan_ready = False
+        self.set_optimistic(False)
+        self._commands.close()
+        self._acks.close()
+        self._throttle.close()
+        self._event_order.clear()
+        await self._event_queue.stop()
+        self._broker = None
+        self._registry = None
         self._broker_event_handler = None
         self._installed_app_id = None
-        await self.post(action="unregister")
+        try:
+            await self.post(action="unregister")
+        except HubError as exc:
+            _LOGGER.warning("Failed to unregister from hub: %s", exc)
+        finally:
+            await self.close()
+
+    async def close(self):
+        '''Close connections to the hub'''
+        session, self._session = self._session, None
+        if self._remove_close_listener:
+            self._remove_close_listener()
+            self._remove_close_listener = None
+        if session:
+            await session.close()
+
+    def _get_session(self) -> ClientSession:
+        session = self._session
+        if session is None or session.closed:
+            session = self._session = _create_session(self._info._instance_id)
+            if not self._remove_close_listener:
+                self._remove_close_listener = self.hass.bus.async_listen_once(
+                    EVENT_HOMEASSISTANT_CLOSE, self._detach_session)
+        return session
+
+    @callback
+    def _detach_session(self, event: Event):
+        '''Drop the connections at shutdown, as the sessions of Home Assistant do'''
+        self._remove_close_listener = None
+        session, self._session = self._session, None
+        if session:
+            session.detach()
 
     @classmethod
-    async def load(cls, *, hass: HomeAssistant):
-        '''load the info from store'''
-        info = await HubInfo.load(hass)
-        access_token, lan_host = await cls._register(
-            hass, lan_webhook_id=info._lan_webhook_id, cloud_webhook_id=info._cloud_callback_path,
-            hub_url=info._hub_url, hub_ip=info._hub_ip)
-        if info._access_token != access_token:
-            info._access_token = access_token
-            await info.save()
-        ret = cls(hass, info=info, lan_host=lan_host)
-        ret.patch_methods()       
-        return ret
+    async def load_all(cls, *, hass: HomeAssistant, location_id: str) -> List["Hub"]:
+        '''load the hubs of the location from store, they register once started'''
+        hubs = [cls(hass, info=info) for info in await HubInfo.load_all(hass, location_id)]
+        for hub in hubs:
+            hub.patch_methods()
+        return hubs
 
     @classmethod
     async def setup(cls, *, hass: HomeAssistant, app: _AppInfo, servername: str):
         '''Create the info and save it'''
-        lan_webhook_id = webhook.async_generate_id()
-        cloud_webhook_id = webhook.async_generate_id()
-        hub_data = app["location"]["hubs"][0]["data"]
-        hub_ip = hub_data["localIP"]
-        port = hub_data["localSrvPortTCP"]
-        hub_url = f"http://{hub_ip}:{port}"
-        instance_id = str(uuid4())
+        shared = await HubInfo.load_shared(hass)
+        # one cloud webhook and instance serve every location
+        cloud_webhook_id = shared.get(CONF_WEBHOOK_ID) or webhook.async_generate_id()
+        instance_id = shared.get(CONF_INSTANCE_ID) or str(uuid4())
+        location_id = app["location"]["id"]
         targeturl_base = f'https://{servername}.api.smartthings.com:443/api/smartapps/installations/{app["id"]}/relay?access_token='
-        access_token, lan_host = await cls._register(hass, lan_webhook_id=lan_webhook_id, hub_url=hub_url, hub_ip=hub_ip, cloud_webhook_id=cloud_webhook_id)
-        info = HubInfo(hass=hass, lan_webhook_id=lan_webhook_id,
-                       hub_ip=hub_ip, hub_url=hub_url,
-                       access_token=access_token,
-                       targeturl_base=targeturl_base, cloud_webhook_id=cloud_webhook_id, instance_id=instance_id)
+        error: Optional[BaseException] = None
+        # the location smartapp needs one registration, use the first hub that answers
+        for hub in app["location"]["hubs"]:
+            hub_data = hub["data"]
+            hub_ip = hub_data["localIP"]
+            port = hub_data["localSrvPortTCP"]
+            hub_url = f"http://{hub_ip}:{port}"
+            info = HubInfo(hass=hass, lan_webhook_id=webhook.async_generate_id(),
+                           hub_ip=hub_ip, hub_url=hub_url, hub_id=hub["id"], location_id=location_id,
+                           mac=hub_data.get("macAddress"),
+                           access_token="",
+                           targeturl_base=targeturl_base, cloud_webhook_id=cloud_webhook_id, instance_id=instance_id)
+            ret = cls(hass, info=info)
+            try:
+                await ret.register()
+            except (HubError, asyncio.TimeoutError, ValueError) as exc:
+                _LOGGER.warning("Failed to register with hub %s: %s", hub["id"], exc)
+                error = exc
+                continue
+            finally:
+                # the hub is only used again once the config entry is loaded
+                await ret.close()
+            # hubs saved by an earlier setup of the location are stale now
+            await info.save(replace=True)
+            ret.patch_methods()
+            return ret
+        raise error or ValueError("No hub found in location")
+
+    async def register(self):
+        '''Register with the hub and save the access token it returns'''
+        info = self._info
+        access_token, lan_host, device_ids = await self._register()
+        self._device_ids = frozenset(device_ids) if device_ids is not None else None
+        self._lan_ready = True
+        if info._access_token != access_token or info._lan_host != lan_host:
+            info._access_token = access_token
+            info._lan_host = lan_host
+            await info.save()
+
+    async def _register_in_background(self):
+        '''Re-register with the hub until it answers'''
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            try:
+                await self.register()
+            except Exception as exc:
+                attempt += 1
+                delay = backoff_delay(attempt, max_delay=REGISTER_RETRY_MAX_DELAY)
+                # without a registration the hub stays on cloud for good, keep trying whatever failed
+                _LOGGER.warning("Failed to register with hub %s, retrying in %.0fs: %s",
+                                self.hub_id, delay, exc or type(exc).__name__,
+                                exc_info=not isinstance(exc, (HubError, asyncio.TimeoutError, ValueError)))
+                await asyncio.sleep(delay)
+                continue
+            elapsed = time.monotonic() - started
+            # the hub answered, no need to wait for the next ping
+            self._ping_failures = 0
+            self._healthy = True
+            self._metrics.registration_time = elapsed
+            _LOGGER.info("LAN link to hub %s confirmed in %.2fs", self.hub_id, elapsed)
+            return
+
+    async def ping(self) -> float:
+        '''Round trip of a ping through the SmartApp, in seconds'''
+        ping_id = uuid4().hex
+        pong = self.hass.loop.create_future()
+        self._pong = (ping_id, pong)
+        started = time.monotonic()
+        try:
+            await self.post("ping", {"id": ping_id}, attempts=1)
+            await asyncio.wait_for(pong, HEALTH_PING_TIMEOUT)
+        finally:
+            self._pong = None
+        return time.monotonic() - started
+
+    async def _monitor_health(self):
+        '''Ping the hub, commands go to cloud while it does not answer.
+
+        Pings also renew the subscription of this instance in the SmartApp.
+        '''
+        while True:
+            await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+            if self._register_task and not self._register_task.done():
+                continue  # registration reports its own failures
+            try:
+                await self._check_health()
+            except Exception:
+                # the subscription lapses if the monitor stops
+                _LOGGER.exception("Health check of hub %s failed", self.hub_id)
+
+    async def _check_health(self):
+        try:
+            rtt = await self.ping()
+        except (HubError, asyncio.TimeoutError) as exc:
+            self._metrics.ping_failures += 1
+            self._ping_failures += 1
+            self._resume_forwarding()
+            if self._healthy and self._ping_failures >= HEALTH_FAILURE_THRESHOLD:
+                self._healthy = False
+                _LOGGER.warning("Hub %s is not answering, commands go through cloud: %s",
+                                self.hub_id, exc or type(exc).__name__)
+            if not self._healthy and not await self._follow_hub_address():
+                # the SmartApp forgets an instance quiet past its lease and stops answering it
+                self._register_task = asyncio.create_task(self._register_in_background())
+            return
+        self._metrics.ping_rtt.observe(rtt)
+        self._ping_failures = 0
+        if not self._healthy:
+            self._healthy = True
+            _LOGGER.info("Hub %s is answering again", self.hub_id)
+        if self._lan_ready:
+            await self._pause_forwarding()
+
+    async def _pause_forwarding(self):
+        '''Have the SmartApp stop forwarding the cloud events it also sends on LAN'''
+        try:
+            await self.post("forwarding", {"pause": FORWARD_PAUSE_LEASE}, attempts=1)
+        except HubError as exc:
+            _LOGGER.debug("Cannot pause cloud forwarding of hub %s: %s", self.hub_id, exc)
+            return
+        if not self._forwarding_paused_until:
+            self._metrics.forwarding_pauses += 1
+            _LOGGER.debug("Cloud forwarding of hub %s paused", self.hub_id)
+        self._forwarding_paused_until = time.monotonic() + FORWARD_PAUSE_LEASE
+
+    def _resume_forwarding(self):
+        '''Have cloud events forwarded again, the lease runs out if the hub cannot be told'''
+        if not self._forwarding_paused_until:
+            return
+        self._forwarding_paused_until = 0.0
+        self._metrics.forwarding_resumes += 1
+        _LOGGER.debug("Cloud forwarding of hub %s resumed", self.hub_id)
+
+        async def resume():
+            try:
+                await self.post("forwarding", {"pause": 0}, attempts=1)
+            except HubError as exc:
+                _LOGGER.debug("Cannot resume cloud forwarding of hub %s: %s", self.hub_id, exc)
+
+        asyncio.create_task(resume())
+
+    def _command_done(self, ack: "asyncio.Future[None]"):
+        if not ack.cancelled() and ack.exception() is not None:
+            self._resume_forwarding()
+
+    async def _follow_hub_address(self) -> bool:
+        '''Ask the SmartApp through cloud where the hub is, re-register if it moved'''
+        info = self._info
+        try:
+            async with async_get_clientsession(self.hass).get(info._hub_lookup_url) as resp:
+                resp.raise_for_status()
+                hubs = await resp.json()
+        except (ClientError, asyncio.TimeoutError, ValueError) as exc:
+            _LOGGER.debug("Cannot look up hub %s: %s", self.hub_id, exc)
+            return False
+        try:
+            hub = next((hub for hub in hubs if hub.get("id") == info._hub_id), hubs[0] if len(hubs) == 1 else None)
+            if not hub:
+                return False
+            hub_ip, port = hub["localIP"], hub["localSrvPortTCP"]
+        except (AttributeError, KeyError, TypeError) as exc:
+            _LOGGER.warning("Unexpected hub lookup response for hub %s: %r", self.hub_id, exc)
+            return False
+        return await self.move_to(hub_ip, port)
+
+    async def move_to(self, hub_ip: str, port: Any = None, mac: Optional[str] = None) -> bool:
+        '''Use the hub at a new address and re-register with it, True if it moved'''
+        info = self._info
+        if mac and info._mac is None:
+            info._mac = mac_key(mac)
+            await info.save()
+        hub_url = f"http://{hub_ip}:{port or urlsplit(info._hub_url).port}"
+        if hub_url == info._hub_url:
+            return False
+        _LOGGER.warning("Hub %s moved from %s to %s", self.hub_id, info._hub_url, hub_url)
+        info._hub_ip = hub_ip
+        info._hub_url = hub_url
         await info.save()
-        ret = cls(hass, info=info, lan_host=lan_host)
-        ret.patch_methods()
-        return ret
+        if not self._broker_event_handler:
+            return True  # not started, registers at start
+        # a retry loop against the old address would only back off further
+        if self._register_task:
+            self._register_task.cancel()
+        self._lan_ready = False
+        self._forwarding_paused_until = 0.0  # registering resumes it
+        self._breaker = CircuitBreaker()
+        self._register_task = asyncio.create_task(self._register_in_background())
+        return True
 
     def patch_methods(self):
         smartapp = sys.modules['custom_components.lan_smartthings.smartthings.smartapp']
@@ -199,42 +602,194 @@ class Hub():
         smartapp._get_app_template = patched_get_app_template
         smartapp.get_webhook_url = lambda hass: self.targeturl
 
-    @classmethod
-    async def _register(cls, hass: HomeAssistant, *, lan_webhook_id: str, hub_url: str, hub_ip: str, cloud_webhook_id: str):
-        registration = hass.loop.create_future()
-
-        async def handler(hass: HomeAssistant, webhook_id: str, request: Request):
-            req = await request.json()
-            if "accessToken" in req:
-                access_token = req["accessToken"]
-                if not registration.done():
-                    registration.set_result(access_token)
-        try:
-            source_ip = async_get_source_ip(hub_ip)
-            if not source_ip:
-                raise ValueError("Cannot find ip address")
-            lan_host = f"{source_ip}:{hass.http.server_port}"
-            # Register webhook
+    async def _register(self) -> Tuple[str, str, Optional[List[str]]]:
+        info = self._info
+        source_ip = async_get_source_ip(info._hub_ip)
+        if not source_ip:
+            raise ValueError("Cannot find ip address")
+        lan_host = f"{source_ip}:{self.hass.http.server_port}"
+        # the hub posts the access token back to the LAN webhook
+        own_webhook = not self._broker_event_handler
+        if own_webhook:
             webhook.async_register(
-                hass, DOMAIN, "SmartApp", lan_webhook_id, handler)
-            await cls._post(
-                hass=hass, action="register", url=hub_url,
-                data={
-                    "host": lan_host,
-                    "path": webhook.async_generate_path(lan_webhook_id),
-                    "forward_path": webhook.async_generate_path(cloud_webhook_id),
-                }
-            )
-            await asyncio.wait_for(registration, 30)
-            access_token = registration.result()
-            webhook.async_unregister(hass, lan_webhook_id)
-            return access_token, lan_host
+                self.hass, DOMAIN, "SmartApp", info._lan_webhook_id, self.webhook_handler)
+        registration = self._registration = self.hass.loop.create_future()
+        try:
+            data = {
+                "host": lan_host,
+                "path": info._lan_callback_path,
+                "forward_path": info._cloud_callback_path,
+                "lease": SUBSCRIBER_LEASE,
+            }
+            if self._subscriptions is not None:
+                data["attributes"] = self._subscriptions
+            await self.post(action="register", data=data)
+            reply = await asyncio.wait_for(registration, REGISTER_TIMEOUT)
+            # the devices selected in the SmartApp, it cannot run commands for others
+            return reply["accessToken"], lan_host, reply.get("devices")
         finally:
-            webhook.async_unregister(hass, lan_webhook_id)
+            self._registration = None
+            if own_webhook:
+                webhook.async_unregister(self.hass, info._lan_webhook_id)
+
+    async def execute_command(self, device_id: str, command: str, args: Any, *, wait: bool = False):
+        '''Send a command, with wait also until the hub acknowledges it'''
+        mapping = OPTIMISTIC_COMMANDS.get(command)
+        if mapping:
+            # the round trip ends with the event of the attribute the command changes
+            self._command_sent[(device_id, mapping[0])] = time.monotonic()
+        optimistic = self._optimistic
+        applied = None
+        if optimistic and self._broker:
+            applied = optimistic.apply(self._broker.devices.get(device_id), command, args)
+        try:
+            command_id = await self._commands.submit(device_id, command, args)
+        except HubError:
+            if applied:
+                optimistic.rollback(applied)
+            self._resume_forwarding()
+            raise
+        ack = self._acks.get(command_id)
+        if ack is None:
+            return  # already acknowledged
+        ack.add_done_callback(self._command_done)
+        if applied:
+            def rollback_failed(future: "asyncio.Future[None]"):
+                if not future.cancelled() and future.exception() is not None:
+                    optimistic.rollback(applied)
+            ack.add_done_callback(rollback_failed)
+        if wait:
+            await asyncio.shield(ack)
+
+    def set_subscriptions(self, subscriptions: Dict[str, List[str]]):
+        '''Limit the attributes the hub sends, re-registering when they change'''
+        if subscriptions == self._subscriptions:
+            return
+        self._subscriptions = subscriptions
+        if not self._broker_event_handler:
+            return  # not started, start registers
+        if self._register_task:
+            self._register_task.cancel()
+        self._register_task = asyncio.create_task(self._register_in_background())
+
+    def set_throttle_rules(self, rules: ThrottleRules):
+        self._throttle.set_rules(rules)
+
+    def set_optimistic(self, enabled: bool):
+        '''Show the expected result of commands before the device confirms it'''
+        if enabled and not self._optimistic:
+            self._optimistic = OptimisticUpdates(
+                lambda device_ids: async_dispatcher_send(self.hass, SIGNAL_SMARTTHINGS_UPDATE, device_ids))
+        elif not enabled and self._optimistic:
+            self._optimistic.close()
+            self._optimistic = None
+
+    def _record_device_event(self, device_id: str, attribute: str, now: float):
+        '''Measure the round trip of the last command changing the attribute'''
+        sent = self._command_sent.pop((device_id, attribute), None)
+        if sent is not None and now - sent < COMMAND_RTT_TIMEOUT:
+            self._metrics.command_rtt.observe(now - sent)
+
+    async def _send_commands(self, commands: List[Dict[str, Any]]):
+        acks = self._acks
+        for command in commands:
+            acks.expect(command["id"])
+        try:
+            if len(commands) == 1:
+                await self.post("command", commands[0])
+            else:
+                await self.post("commands", {"commands": commands})
+        except HubError as exc:
+            acks.discard((command["id"] for command in commands), exc)
+            raise
 
-    async def execute_command(self, device_id: str, command: str, args: Any):
-        await self.post("command", {"command": command,
-                                    "device_id": device_id, "args": args})
+    @property
+    def command_queue(self) -> CommandQueue:
+        return self._commands
+
+    @property
+    def breaker_state(self) -> str:
+        return self._breaker.state
+
+    @property
+    def metrics(self) -> HubMetrics:
+        return self._metrics
+
+    @property
+    def healthy(self) -> bool:
+        return self._healthy
+
+    def diagnostics(self) -> Dict[str, Any]:
+        commands = self._commands
+        event_queue = self._event_queue
+        optimistic = self._optimistic
+        return {
+            "breaker_state": self._breaker.state,
+            "lan_ready": self._lan_ready,
+            "healthy": self._healthy,
+            "cloud_forwarding_paused": self._forwarding_paused_until > time.monotonic(),
+            "hub_url": self._info._hub_url,
+            "mac": self._info._mac,
+            "metrics": self._metrics.as_dict(),
+            "commands": {
+                "sent": commands.sent,
+                "batches": commands.batches,
+                "merged": commands.merged,
+                "dropped": commands.dropped,
+            },
+            "event_queue": {
+                "depth": event_queue.depth,
+                "max_depth": event_queue.max_depth,
+                "dropped": event_queue.dropped,
+            },
+            "acks": {
+                "pending": len(self._acks),
+                "acked": self._acks.acked,
+                "failed": self._acks.failed,
+                "timed_out": self._acks.timed_out,
+                "evicted": self._acks.evicted,
+            },
+            "dedup_size": len(self._seen_events),
+            "order_size": len(self._event_order),
+            "lan_devices": len(self._device_ids) if self._device_ids is not None else None,
+            "subscribed_attributes": sum(map(len, self._subscriptions.values())) if self._subscriptions else None,
+            "throttle": {
+                "suppressed": dict(self._throttle.suppressed),
+                "flushed": self._throttle.flushed,
+            },
+            "optimistic": {
+                "pending": len(optimistic),
+                "applied": optimistic.applied,
+                "confirmed": optimistic.confirmed,
+                "rolled_back": optimistic.rolled_back,
+            } if optimistic else None,
+        }
+
+    @property
+    def lan_ready(self) -> bool:
+        '''True once the hub confirmed the LAN link and while it answers pings'''
+        return self._lan_ready and self._healthy and self._breaker.state != BREAKER_OPEN
+
+    @property
+    def hub_id(self) -> str:
+        return self._info._hub_id
+
+    @property
+    def location_id(self) -> str:
+        return self._info._location_id
+
+    def serves(self, device_id: str) -> bool:
+        '''True if the SmartApp runs commands for the device'''
+        device_ids = self._device_ids
+        return device_ids is None or device_id in device_ids
+
+    @property
+    def hub_ip(self) -> str:
+        return self._info._hub_ip
+
+    @property
+    def mac(self) -> Optional[str]:
+        return self._info._mac
 
     @property
     def targeturl(self):
@@ -244,76 +799,162 @@ class Hub():
     def cloud_webhook_id(self):
         return self._info._cloud_webhook_id
 
-    async def _handle_lan_event(self, data):
-        if not "event" in data:
+    def _handle_lan_event(self, data):
+        if "events" in data:  # batched by the hub
+            lan_events = data["events"]
+        elif "event" in data:
+            lan_events = [data["event"]]
+        else:
             return
-        json_data = data['event']
-        event_id = json_data["eventId"]
-        if self._last_event_id == event_id:  # ignore duplicate event
+        self._metrics.events_received[PATH_LAN] += len(lan_events)
+        seen = self._seen_events.seen
+        stale = self._event_order.stale
+        lan_events = [evt for evt in (LanEvent(json_data) for json_data in lan_events
+                                      if not seen(json_data["eventId"], PATH_LAN))  # ignore duplicate events
+                      if not stale(evt.device_id, evt.attribute, evt.time)]
+        if not lan_events:
             return
-        self._last_event_id = event_id
-        req = EventRequest({
-            'lifecycle': "",
-            'executionId': "",
-            'locale': "",
-            'version': "",
-            'settings': "",
-            "eventData": {
-                "authToken": "",
-                "installedApp": {
-                        'installedAppId': self._installed_app_id,
-                        'locationId': json_data["locationId"],
-                        'config': "",
-                },
-                "events": [
-                    {
-                        'eventType': EVENT_TYPE_DEVICE,
-                        "deviceEvent": {
-                            'subscriptionName': "",
-                            'eventId': json_data["eventId"],
-                            'locationId': json_data["locationId"],
-                            'deviceId': json_data["deviceId"],
-                            'componentId': "main",
-                            'capability': "",
-                            'attribute': json_data["attribute"],
-                            'value': json_data["value"],
-                            'valueType': "",
-                            'data': json_data["data"],
-                            'stateChange': json_data["stateChange"]
-                        },
-
-                    }],
-            },
-        })
+        if self._command_sent:
+            now = time.monotonic()
+            for evt in lan_events:
+                self._record_device_event(evt.device_id, evt.attribute, now)
+        lan_events = self._throttle.filter(lan_events)
+        if lan_events:
+            self._event_queue.put(lan_events)
+
+    @property
+    def event_queue(self) -> EventQueue:
+        return self._event_queue
+
+    def _dispatch(self, lan_events: List[LanEvent]):
+        '''Apply LAN events to the broker devices and notify entities'''
+        registry = self._registry
+        if not registry:
+            return
+        brokers = registry.brokers
+        hass = self.hass
+        optimistic = self._optimistic
+        updated_devices = set()
+        for evt in lan_events:
+            broker = brokers.get(evt.location_id)
+            device = broker.devices.get(evt.device_id) if broker else None
+            if not device:
+                continue
+            if optimistic:
+                optimistic.confirm(evt.device_id, evt.attribute)
+            device.status.apply_attribute_update(
+                "main", "", evt.attribute, evt.value, data=evt.data)
+            if evt.attribute == Attribute.button:
+                hass.bus.async_fire(EVENT_BUTTON, {
+                    "component_id": "main",
+                    "device_id": evt.device_id,
+                    "location_id": evt.location_id,
+                    "value": evt.value,
+                    "name": device.label,
+                    "data": evt.data,
+                })
+            updated_devices.add(evt.device_id)
+        if updated_devices:
+            async_dispatcher_send(hass, SIGNAL_SMARTTHINGS_UPDATE, updated_devices)
+
+    async def cloud_event_handler(self, req: EventRequest, resp: Any, app: Any):
+        '''Filter events forwarded by cloud that were already received on LAN'''
+        # every loaded entry shares the SmartApp, the broker would skip other locations' events too
+        if req.installed_app_id != self._installed_app_id:
+            return
+        events = req.events
+        seen = self._seen_events.seen
+        device_events = [evt for evt in events if evt.event_type == EVENT_TYPE_DEVICE]
+        self._metrics.events_received[PATH_CLOUD] += len(device_events)
+        # eventTime and the time of LAN events (evt.date) both are when SmartThings recorded the event
+        times = {raw["deviceEvent"]["eventId"]: cloud_event_time(raw) for raw in req.event_data_raw["events"]
+                 if raw.get("eventType") == EVENT_TYPE_DEVICE}
+        stale = self._event_order.stale
+        events = [evt for evt in events
+                  if evt.event_type != EVENT_TYPE_DEVICE
+                  or not (seen(evt.event_id, PATH_CLOUD)
+                          or stale(evt.device_id, evt.attribute, times.get(evt.event_id)))]
+        if self._command_sent:
+            now = time.monotonic()
+            for evt in events:
+                if evt.event_type == EVENT_TYPE_DEVICE:
+                    self._record_device_event(evt.device_id, evt.attribute, now)
+        optimistic = self._optimistic
+        if optimistic:
+            for evt in events:
+                if evt.event_type == EVENT_TYPE_DEVICE:
+                    optimistic.confirm(evt.device_id, evt.attribute)
         handler = self._broker_event_handler
-        if not handler:
-            raise ValueError("Handler is unexpectedly None")
-        await handler(req)
+        if not events or not handler:
+            return
+        # the request goes to the other handlers of the SmartApp as it came
+        filtered = copy.copy(req)
+        filtered._events = events
+        await handler(filtered)
 
     async def webhook_handler(self, hass: HomeAssistant, webhook_id: str, request: Request):
+        # respond as soon as the events are queued so the hub is not kept waiting
         req = await request.json()
-        await self._handle_lan_event(req)
-
-    async def post(self, action: str, data: Any = None):
+        if "accessToken" in req:
+            registration = self._registration
+            if registration and not registration.done():
+                registration.set_result(req)
+            return
+        if "pong" in req:
+            pong = self._pong
+            if pong and pong[0] == req["pong"] and not pong[1].done():
+                pong[1].set_result(None)
+        elif "ack" in req:
+            self._acks.resolve(req["ack"])
+        elif "acks" in req:
+            for ack in req["acks"]:
+                self._acks.resolve(ack)
+        else:
+            self._handle_lan_event(req)
+
+    async def post(self, action: str, data: Any = None, *, attempts: int = RETRY_MAX_ATTEMPTS):
         info = self._info
         hub_url = cast(str, info._hub_url)
-        await self._post(hass=self.hass, url=hub_url, action=action, data=data)
+        await self._post(session=self._get_session(), breaker=self._breaker, metrics=self._metrics,
+                         url=hub_url, action=action, data=data, attempts=attempts)
 
     @staticmethod
-    async def _post(*, hass: HomeAssistant, url: str, action: str, data: Any = None):
-        to = ClientTimeout(total=5.0)
-        session = async_get_clientsession(hass)
-        headers = {hdrs.USER_AGENT: USER_AGENTv1, "Action": action}
+    async def _post(*, session: ClientSession, breaker: CircuitBreaker, metrics: HubMetrics,
+                    url: str, action: str, data: Any = None, attempts: int = RETRY_MAX_ATTEMPTS):
+        headers = _action_headers(action)
         attempt = 0
-        max_attempt = 5
-        while attempt < max_attempt:
+        while True:
             try:
-                async with session.request("POST", url, headers=headers, json=data,timeout=to) as resp:
-                    result = await resp.text()
-                    return
-            except asyncio.TimeoutError:
-                attempt+=1
-                await asyncio.sleep(2)
+                probe = breaker.before_request()
+            except HubUnavailable:  # breaker is open
+                metrics.post_failures += 1
+                raise
+            try:
+                async with session.request("POST", url, headers=headers, json=data) as resp:
+                    await resp.read()
+            except asyncio.CancelledError:
+                if probe:
+                    breaker.cancel_request()
+                raise
+            except (asyncio.TimeoutError, ClientConnectionError) as exc:
+                breaker.record_failure()
+                attempt += 1
+                if attempt >= attempts:
+                    metrics.post_failures += 1
+                    raise HubUnavailable(f"Hub did not respond to {action}") from exc
+                metrics.post_retries += 1
+                _LOGGER.debug("Retrying %s after %s (attempt %d)", action, exc or type(exc).__name__, attempt)
+                await asyncio.sleep(backoff_delay(attempt))
+                continue
+            except ClientError as exc:
+                # the hub may have run the command, a retry or cloud could run it twice
+                breaker.record_failure()
+                metrics.post_failures += 1
+                raise HubError(f"Hub failed to handle {action}: {exc}") from exc
             except Exception as exc:
+                breaker.record_failure()
+                metrics.post_failures += 1
                 _LOGGER.error(exc)
                 raise
+            breaker.record_success()
+            return
@@ -0,0 +1,66 @@
+"""Counters and latency histograms for the LAN and cloud paths."""
+import bisect
+from typing import Any, Dict, List, Optional, Sequence
+
+from .const import LATENCY_BUCKETS, PATH_CLOUD, PATH_LAN
+
+
+class Histogram():
+    '''Histogram with fixed buckets, so memory does not grow with samples'''
+    __slots__ = ("_bounds", "_counts", "count", "total")
+
+    def __init__(self, bounds: Sequence[float] = LATENCY_BUCKETS) -> None:
+        self._bounds = tuple(bounds)
+        self._counts: List[int] = [0] * (len(self._bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value: float):
+        self._counts[bisect.bisect_left(self._bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def as_dict(self) -> Dict[str, Any]:
+        buckets = {f"le_{bound}": count for bound, count in zip(self._bounds, self._counts)}
+        buckets["inf"] = self._counts[-1]
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "buckets": buckets,
+        }
+
+
+class HubMetrics():
+    '''Traffic statistics of a single hub'''
+
+    def __init__(self) -> None:
+        self.events_received = {PATH_LAN: 0, PATH_CLOUD: 0}
+        self.race_wins = {PATH_LAN: 0, PATH_CLOUD: 0}
+        self.race_lag = Histogram()
+        self.command_rtt = Histogram()
+        self.command_ack = Histogram()
+        self.ping_rtt = Histogram()
+        self.ping_failures = 0
+        self.stale_events = 0
+        self.forwarding_pauses = 0
+        self.forwarding_resumes = 0
+        self.post_retries = 0
+        self.post_failures = 0
+        self.registration_time: Optional[float] = None
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "events_received": dict(self.events_received),
+            "race_wins": dict(self.race_wins),
+            "race_lag": self.race_lag.as_dict(),
+            "command_rtt": self.command_rtt.as_dict(),
+            "command_ack": self.command_ack.as_dict(),
+            "ping_rtt": self.ping_rtt.as_dict(),
+            "ping_failures": self.ping_failures,
+            "stale_events": self.stale_events,
+            "forwarding_pauses": self.forwarding_pauses,
+            "forwarding_resumes": self.forwarding_resumes,
+            "post_retries": self.post_retries,
+            "post_failures": self.post_failures,
+            "registration_time": self.registration_time,
+        }
@@ -0,0 +1,100 @@
+"""Optimistic device state for commands sent over LAN."""
+import asyncio
+import logging
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+
+from pysmartthings import DeviceEntity
+
+from .const import OPTIMISTIC_COMMANDS, OPTIMISTIC_TIMEOUT
+
+NotifyDevices = Callable[[Set[str]], None]
+_LOGGER = logging.getLogger(__name__)
+
+
+class _Pending():
+    __slots__ = ("device", "expected", "previous", "timer")
+
+    def __init__(self, device: DeviceEntity, expected: Any, previous: Any,
+                 timer: asyncio.TimerHandle) -> None:
+        self.device = device
+        self.expected = expected
+        self.previous = previous
+        self.timer = timer
+
+
+class OptimisticUpdates():
+    '''Apply the expected result of a command before the device reports it.
+
+    The expected attribute value is written to the device status right away
+    and entities are notified. The next event for that attribute, LAN or
+    cloud, confirms it. Without one within ``timeout`` seconds, or when the
+    command fails, the previous value is restored unless something else
+    changed the attribute meanwhile.
+    '''
+
+    def __init__(self, notify: NotifyDevices, *, timeout: float = OPTIMISTIC_TIMEOUT) -> None:
+        self._notify = notify
+        self._timeout = timeout
+        self._pending: Dict[Tuple[str, str], _Pending] = {}
+        self.applied = 0
+        self.confirmed = 0
+        self.rolled_back = 0
+
+    def apply(self, device: Optional[DeviceEntity], command: str, args: Any) -> Optional[Tuple[str, str]]:
+        '''Apply the expected result of command, returns the key to roll back'''
+        mapping = OPTIMISTIC_COMMANDS.get(command)
+        if mapping is None or device is None:
+            return None
+        attribute, expected = mapping
+        if expected is None:
+            if not args:
+                return None
+            expected = args[0]
+        status = device.status.attributes.get(attribute)
+        if status is None or status.value == expected:
+            return None
+        key = (device.device_id, attribute)
+        pending = self._pending.pop(key, None)
+        if pending:
+            # keep the value from before the first unconfirmed command
+            pending.timer.cancel()
+            previous = pending.previous
+        else:
+            previous = status
+        timer = asyncio.get_running_loop().call_later(self._timeout, self.rollback, key)
+        self._pending[key] = _Pending(device, expected, previous, timer)
+        device.status.apply_attribute_update("main", "", attribute, expected)
+        self.applied += 1
+        self._notify({device.device_id})
+        return key
+
+    def confirm(self, device_id: str, attribute: str):
+        '''An event for the attribute arrived, it carries the real value'''
+        pending = self._pending.pop((device_id, attribute), None)
+        if pending:
+            pending.timer.cancel()
+            self.confirmed += 1
+
+    def rollback(self, key: Tuple[str, str]):
+        pending = self._pending.pop(key, None)
+        if not pending:
+            return
+        pending.timer.cancel()
+        device_id, attribute = key
+        status = pending.device.status
+        if status.attributes[attribute].value != pending.expected:
+            return
+        previous = pending.previous
+        status.apply_attribute_update("main", "", attribute, previous.value,
+                                      previous.unit, previous.data)
+        self.rolled_back += 1
+        _LOGGER.debug("Rolled back %s of %s to %s", attribute, device_id, previous.value)
+        self._notify({device_id})
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def close(self):
+        for pending in self._pending.values():
+            pending.timer.cancel()
+        self._pending.clear()
@@ -1,9 +1,13 @@
 import logging
+import marshal
 import os
+import sys
+import time
 from importlib.abc import MetaPathFinder
 from importlib.machinery import ModuleSpec, SourceFileLoader
+from importlib.util import MAGIC_NUMBER
 import importlib
-from typing import List
+from typing import Dict, List, Optional, Tuple
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -14,49 +18,50 @@ SOURCE_PACKAGE_NAME = "homeassistant.components.smartthings"
 MY_DIR_ROOT = os.path.dirname(__file__)[:-len(MY_PACKAGE_NAME)]
 source = importlib.import_module(SOURCE_PACKAGE_NAME)
 SOURCE_DIR = os.path.dirname(source.__file__)[:-len(SOURCE_PACKAGE_NAME)]
+BYTECODE_DIR = os.path.join(os.path.dirname(__file__), "__pycache__", "proxy")
 
 PATH_TREE: List[str] = []
+# module name -> seconds spent executing it, including its own imports
+IMPORT_TIMINGS: Dict[str, float] = {}
+# module name -> (origin, is_package), None when there is no such module
+_RESOLVED: Dict[str, Optional[Tuple[str, bool]]] = {}
 
 
 class RedirectPackageFinder(MetaPathFinder):
     @staticmethod
-    def get_spec(package_name: str) -> ModuleSpec:
-        if package_name.startswith(PROXY_PACKAGE_NAME):  # first check proxy
-            source_path = WrappedLoader.sourcepath(package_name)
-            if not os.path.exists(source_path):
-                return None
+    def _resolve(package_name: str) -> Optional[Tuple[str, bool]]:
+        if package_name in _RESOLVED:
+            return _RESOLVED[package_name]
+        resolved = None
+        if os.path.exists(WrappedLoader.sourcepath(package_name)):
             filepath = os.path.join(MY_DIR_ROOT, *package_name.split("."))
-            loader = WrappedLoader(package_name, None)
-            spec = ModuleSpec(package_name,
-                              origin=filepath,
-                              loader=loader,
-                              is_package=package_name == PROXY_PACKAGE_NAME)
-            spec.has_location = True
-            return spec
-        if package_name.startswith(MY_PACKAGE_NAME):
-            source_path = WrappedLoader.sourcepath(package_name)
-            if not os.path.exists(source_path):
-                return None
-            filepath = os.path.join(MY_DIR_ROOT, *package_name.split("."))
-            loader = WrappedLoader(package_name, None)
-            spec = ModuleSpec(package_name,
-                              origin=filepath,
-                              loader=loader,
-                              is_package=package_name == MY_PACKAGE_NAME)
-            spec.has_location = True
-            return spec
-        return None
+            resolved = (filepath, package_name in (PROXY_PACKAGE_NAME, MY_PACKAGE_NAME))
+        _RESOLVED[package_name] = resolved
+        return resolved
 
-    def find_spec(self, fullname: str, path, target=None):
+    @classmethod
+    def get_spec(cls, package_name: str) -> ModuleSpec:
+        resolved = cls._resolve(package_name)
+        if not resolved:
+            return None
+        filepath, is_package = resolved
+        loader = WrappedLoader(package_name, None)
+        spec = ModuleSpec(package_name,
+                          origin=filepath,
+                          loader=loader,
+                          is_package=is_package)
+        spec.has_location = True
+        return spec
 
+    def find_spec(self, fullname: str, path, target=None):
+        # every import passes through here, reject anything not ours first
+        if not fullname.startswith(MY_PACKAGE_NAME):
+            return None
         if fullname.startswith(PROXY_PACKAGE_NAME):
             if PATH_TREE and PATH_TREE[-1].startswith(PROXY_PACKAGE_NAME):
                 # called from proxy so redirect to our package
                 fullname = MY_PACKAGE_NAME + fullname[len(PROXY_PACKAGE_NAME):]
-                return self.get_spec(fullname)
-        if fullname.startswith(MY_PACKAGE_NAME):
-            return self.get_spec(fullname)
-        return None
+        return self.get_spec(fullname)
 
 
 class WrappedLoader(SourceFileLoader):
@@ -80,9 +85,46 @@ class WrappedLoader(SourceFileLoader):
     def get_filename(self, name):
         return self.sourcepath(name)
 
+    @staticmethod
+    def bytecodepath(name):
+        return os.path.join(BYTECODE_DIR, f"{name}.{sys.implementation.cache_tag}.pyc")
+
+    def get_code(self, fullname):
+        if not fullname.startswith(PROXY_PACKAGE_NAME):
+            return super().get_code(fullname)
+        # proxied modules get their own cache as they share the source with
+        # homeassistant.components.smartthings
+        source_path = self.get_filename(fullname)
+        bytecode_path = self.bytecodepath(fullname)
+        st = self.path_stats(source_path)
+        header = MAGIC_NUMBER + (0).to_bytes(4, "little") + \
+            (int(st["mtime"]) & 0xFFFFFFFF).to_bytes(4, "little") + \
+            (st["size"] & 0xFFFFFFFF).to_bytes(4, "little")
+        try:
+            with open(bytecode_path, "rb") as file:
+                data = file.read()
+            if data[:16] == header:
+                return marshal.loads(data[16:])
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+        code = self.source_to_code(self.get_data(source_path), source_path)
+        try:
+            os.makedirs(BYTECODE_DIR, exist_ok=True)
+            temp_path = f"{bytecode_path}.{os.getpid()}"
+            with open(temp_path, "wb") as file:
+                file.write(header + marshal.dumps(code))
+            os.replace(temp_path, bytecode_path)
+        except OSError as exc:
+            _LOGGER.debug("Cannot cache bytecode of %s: %s", fullname, exc)
+        return code
+
     def exec_module(self, module) -> None:
         PATH_TREE.append(module.__name__)
         _LOGGER.debug(f"Entering module {module.__name__}")
-        super().exec_module(module)
-        name = PATH_TREE.pop()
-        _LOGGER.debug(f"Exiting module {name}")
+        started = time.perf_counter()
+        try:
+            super().exec_module(module)
+        finally:
+            name = PATH_TREE.pop()
+            IMPORT_TIMINGS[name] = time.perf_counter() - started
+        _LOGGER.debug(f"Exiting module {name} after {IMPORT_TIMINGS[name] * 1000:.1f}ms")
@@ -0,0 +1,81 @@
+"""Retry policy and circuit breaker for requests to the hub."""
+import random
+import time
+
+from homeassistant.exceptions import HomeAssistantError
+
+from .const import BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT, RETRY_BASE_DELAY, RETRY_MAX_DELAY
+
+BREAKER_CLOSED = "closed"
+BREAKER_OPEN = "open"
+BREAKER_HALF_OPEN = "half_open"
+
+
+class HubError(HomeAssistantError):
+    """A request to the hub failed."""
+
+
+class HubUnavailable(HubError):
+    """The hub did not respond or is known to be down."""
+
+
+def backoff_delay(attempt: int, *, base_delay: float = RETRY_BASE_DELAY,
+                  max_delay: float = RETRY_MAX_DELAY) -> float:
+    '''Exponential backoff with full jitter for the given (1 based) attempt'''
+    return random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker():
+    '''Fail fast while the hub is known to be down.
+
+    After ``failure_threshold`` consecutive failures the breaker opens and
+    every request fails immediately. Once ``reset_timeout`` has passed a
+    single probe request is let through (half open); its outcome closes or
+    re-opens the breaker.
+    '''
+
+    def __init__(self, *, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout: float = BREAKER_RESET_TIMEOUT) -> None:
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._state = BREAKER_CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    @property
+    def failures(self) -> int:
+        return self._failures
+
+    def before_request(self) -> bool:
+        '''raise HubUnavailable if the request must not be sent, True if it is the probe'''
+        if self._state == BREAKER_OPEN:
+            if time.monotonic() - self._opened_at < self._reset_timeout:
+                raise HubUnavailable("Hub is unavailable")
+            self._state = BREAKER_HALF_OPEN
+        if self._state == BREAKER_HALF_OPEN:
+            if self._probing:
+                raise HubUnavailable("Hub is unavailable")
+            self._probing = True
+            return True
+        return False
+
+    def cancel_request(self):
+        '''the request was cancelled before it had an outcome, let another probe through'''
+        self._probing = False
+
+    def record_success(self):
+        self._failures = 0
+        self._probing = False
+        self._state = BREAKER_CLOSED
+
+    def record_failure(self):
+        self._failures += 1
+        self._probing = False
+        if self._state == BREAKER_HALF_OPEN or self._failures >= self._failure_threshold:
+            self._state = BREAKER_OPEN
+            self._opened_at = time.monotonic()
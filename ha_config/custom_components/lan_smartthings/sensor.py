@@ -1,2 +1,61 @@
 """Support for sensors through the SmartThings cloud API."""
-from .smartthings.sensor  import * 
+from .smartthings.sensor  import *
+from datetime import timedelta
+from typing import Any, Dict, Optional
+
+from homeassistant.components.sensor import SensorEntity
+from homeassistant.config_entries import ConfigEntry
+from homeassistant.core import HomeAssistant
+
+from .const import PATH_CLOUD, PATH_LAN
+from .diagnostics import entry_diagnostics
+from .retry import BREAKER_OPEN
+from .smartthings.sensor import async_setup_entry as origin_async_setup_entry
+
+# only the diagnostics sensor polls, device sensors are pushed
+SCAN_INTERVAL = timedelta(seconds=30)
+
+
+async def async_setup_entry(hass: HomeAssistant, config_entry: ConfigEntry, async_add_entities):
+    await origin_async_setup_entry(hass, config_entry, async_add_entities)
+    async_add_entities([LanDiagnosticsSensor(hass, config_entry)])
+
+
+class LanDiagnosticsSensor(SensorEntity):
+    '''Path commands take and a summary of the hub metrics, for versions without diagnostics downloads'''
+
+    _attr_entity_registry_enabled_default = False
+    _attr_icon = "mdi:lan"
+
+    def __init__(self, hass: HomeAssistant, entry: ConfigEntry) -> None:
+        self.hass = hass
+        self._entry = entry
+        self._attr_name = f"{entry.title} LAN diagnostics"
+        self._attr_unique_id = f"{entry.entry_id}.lan_diagnostics"
+        self._diagnostics: Dict[str, Any] = {}
+
+    async def async_update(self):
+        self._diagnostics = entry_diagnostics(self.hass, self._entry)
+
+    @property
+    def state(self) -> Optional[str]:
+        hubs = self._diagnostics.get("hubs")
+        if not hubs:
+            return None
+        return "lan" if any(hub["lan_ready"] and hub["healthy"] for hub in hubs.values()) else "cloud"
+
+    @property
+    def extra_state_attributes(self) -> Dict[str, Any]:
+        # totals of the entry's hubs, the diagnostics download has the rest
+        hubs = list(self._diagnostics.get("hubs", {}).values())
+        rtts = [hub["metrics"]["command_rtt"] for hub in hubs]
+        rtt_count = sum(rtt["count"] for rtt in rtts)
+        rtt_total = sum(rtt["mean"] * rtt["count"] for rtt in rtts if rtt["count"])
+        return {
+            "hubs": len(hubs),
+            "breakers_open": sum(hub["breaker_state"] == BREAKER_OPEN for hub in hubs),
+            "lan_events": sum(hub["metrics"]["events_received"][PATH_LAN] for hub in hubs),
+            "cloud_events": sum(hub["metrics"]["events_received"][PATH_CLOUD] for hub in hubs),
+            "command_rtt_mean": round(rtt_total / rtt_count, 4) if rtt_count else None,
+            "commands_failed": sum(hub["acks"]["failed"] + hub["acks"]["timed_out"] for hub in hubs),
+        }
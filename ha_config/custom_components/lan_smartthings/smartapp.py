@@ -20,9 +20,11 @@ async def handle_request(self, data: dict, headers: dict = None,
 SmartAppManager.handle_request = handle_request
 
 
-from .const import CLASSIC_APP_NAME
-from typing import Dict, List, Tuple
+from .const import CLASSIC_APP_NAME, CLASSIC_APPS_TTL, DISCOVERY_PARALLELISM
+from typing import Any, Dict, List, Optional, Tuple
+import asyncio
 import logging
+import time
 from aiohttp.client import ClientSession
 from .hub import _AppInfo, _SmartApps
 import re
@@ -36,52 +38,68 @@ PATTERN = r'\"https:\/\/([^\.]*)\.api\.smartthings\.com:443\/location\/installed
 
 PAT = r'<td>.*href="\/installedSmartApp\/show\/([-a-f0-9]*)"[^>]*>(.*)[^<]<.*<\/td>\s*<td>(.*)<\/td>\s*<td>(.*)<\/td>\s*<td>.*href="\/location\/show\/([-a-f0-9]*)".*<\/td>'
 
-INSTALATIONS = "https://{servername}.api.smartthings.com:443/api/smartapps/installations"
-INSTALATION_STATE = "https://{servername}.api.smartthings.com:443/installedSmartApp/showModal/{appid}"
-INSTALL_STATE_PATTERN = re.compile(
-    r'.*(?<=<h4>Application State<\/h4>)(.*)', re.DOTALL)
-STATE_BODY = re.compile('.*(?<=<tbody>)(.*)(?=<\\/tbody>).*', re.DOTALL)
+LOCATION_LIST = "https://graph.api.smartthings.com/location/list"
+SERVER_URL = "https://{servername}.api.smartthings.com:443"
+INSTALATIONS = "{server_url}/api/smartapps/installations"
+INSTALATION_STATE = "{server_url}/installedSmartApp/showModal/{appid}"
+LOCATION_PATTERN = re.compile(PATTERN)
+INSTALL_STATE_HEADER = "<h4>Application State</h4>"
 PROP_PATTERN = re.compile(
     r'<tr>\s*<td>(.*?)<\/td>\s*<td>(.*?)<\/td>\s*<\/tr>', re.DOTALL)
 
+# access token -> (expiry, result) so re-entering the flow does not crawl again
+_CACHE: Dict[str, Tuple[float, _SmartApps]] = {}
 
-async def classic_smartapps(session: ClientSession, access_token: str) -> _SmartApps:
-    async with session.request(
-        "GET", "https://graph.api.smartthings.com/location/list",
-        headers={"Authorization": "Bearer " + access_token},
-    ) as resp:
-        html = await resp.text()
-    matches: List[Tuple[str, str]] = re.findall(PATTERN, html)
+
+def _app_state(html: str) -> Optional[Dict[str, str]]:
+    start = html.find(INSTALL_STATE_HEADER)
+    if start < 0:
+        return None
+    start = html.find("<tbody>", start)
+    end = html.find("</tbody>", start)
+    if start < 0 or end < 0:
+        return None
+    return dict(PROP_PATTERN.findall(html, start, end))
+
+
+async def classic_smartapps(session: ClientSession, access_token: str, *,
+                            location_list: str = LOCATION_LIST,
+                            server_url: str = SERVER_URL) -> _SmartApps:
+    cached = _CACHE.get(access_token)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    headers = {"Authorization": "Bearer " + access_token}
+    semaphore = asyncio.Semaphore(DISCOVERY_PARALLELISM)
+
+    async def get(url: str, as_json: bool = False) -> Any:
+        async with semaphore, session.request("GET", url, headers=headers) as resp:
+            return await resp.json() if as_json else await resp.text()
+
+    html = await get(location_list)
+    matches: List[Tuple[str, str]] = LOCATION_PATTERN.findall(html)
     if not matches:
         raise ValueError("no_available_locations")
     loc_server_map = {l: s for s, l in matches}
-    servers = {*loc_server_map.values()}
-    classic_apps: List[_AppInfo] = []
-    for servername in servers:
-        async with session.request(
-            "GET", INSTALATIONS.format_map({"servername": servername}),
-            headers={"Authorization": "Bearer " + access_token},
-        ) as resp:
-            apps = await resp.json()
-            myapps: List[_AppInfo] = [app for app in apps if app["smartAppVersion"]
-                                      ["name"] == CLASSIC_APP_NAME]
-
-            classic_apps.extend(myapps)
+    servers = [server_url.format_map({"servername": servername})
+               for servername in {*loc_server_map.values()}]
+    installations = await asyncio.gather(
+        *(get(INSTALATIONS.format_map({"server_url": server}), as_json=True) for server in servers))
+    # keep the server each app was listed on, its state page lives there too
+    classic_apps: List[Tuple[str, _AppInfo]] = [
+        (server, app) for server, apps in zip(servers, installations)
+        for app in apps if app["smartAppVersion"]["name"] == CLASSIC_APP_NAME]
     if not classic_apps:
         raise ValueError("classic_smartapp_not_installed")
+    pages = await asyncio.gather(
+        *(get(INSTALATION_STATE.format_map({"server_url": server, "appid": app["id"]}))
+          for server, app in classic_apps))
     properties: Dict[str, Dict[str, str]] = {}
-    for capps in classic_apps:
-        async with session.request(
-            "GET", INSTALATION_STATE.format_map(
-                {"servername": servername, "appid": capps["id"]}),
-            headers={"Authorization": "Bearer " + access_token},
-        ) as resp:
-            html = await resp.text()
-        try:
-            app_state = PROP_PATTERN.findall(STATE_BODY.match(
-                INSTALL_STATE_PATTERN.match(html)[1])[1])
-            props = {k: v for k, v in app_state}
-            properties[capps["id"]] = props
-        except:
-            pass
-    return _SmartApps(classic_apps, loc_server_map, properties)
+    for (_, app), page in zip(classic_apps, pages):
+        props = _app_state(page)
+        if props is None:
+            _LOGGER.debug("No application state found for %s", app["id"])
+            continue
+        properties[app["id"]] = props
+    result = _SmartApps([app for _, app in classic_apps], loc_server_map, properties)
+    _CACHE[access_token] = (time.monotonic() + CLASSIC_APPS_TTL, result)
+    return result
@@ -0,0 +1,115 @@
+"""Last known devices of a location, persisted for warm starts."""
+import logging
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from homeassistant.core import HomeAssistant
+from homeassistant.helpers.storage import Store
+from pysmartthings import DeviceEntity, SceneEntity
+from pysmartthings.device import DeviceStatusBase
+
+from .const import SNAPSHOT_SAVE_DELAY, STORAGE_VERSION
+from .hub import _location_storage_key
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def _attributes_as_dict(status: DeviceStatusBase) -> Dict[str, Any]:
+    # attributes are not kept per capability, the capability is left empty
+    # like for LAN events
+    return {"": {attribute: {"value": value.value, "unit": value.unit, "data": value.data}
+                 for attribute, value in status.attributes.items()}}
+
+
+def status_as_dict(device: DeviceEntity) -> Dict[str, Any]:
+    '''Device status in the shape of the SmartThings status response'''
+    status = device.status
+    components = {"main": _attributes_as_dict(status)}
+    for component_id, component in status.components.items():
+        components[component_id] = _attributes_as_dict(component)
+    return {"components": components}
+
+
+def device_as_dict(device: DeviceEntity) -> Dict[str, Any]:
+    '''Device description in the shape of the SmartThings devices response'''
+    components = [{"id": "main", "capabilities": [{"id": capability} for capability in device.capabilities]}]
+    components.extend({"id": component_id, "capabilities": [{"id": capability} for capability in capabilities]}
+                      for component_id, capabilities in device.components.items())
+    return {
+        "deviceId": device.device_id,
+        "name": device.name,
+        "label": device.label,
+        "locationId": device.location_id,
+        "roomId": device.room_id,
+        "type": device.type,
+        "components": components,
+        "dth": {
+            "deviceTypeId": device.device_type_id,
+            "deviceTypeName": device.device_type_name,
+            "deviceNetworkType": device.device_type_network,
+        },
+    }
+
+
+def scene_as_dict(scene: SceneEntity) -> Dict[str, Any]:
+    return {
+        "sceneId": scene.scene_id,
+        "sceneName": scene.name,
+        "sceneIcon": scene.icon,
+        "sceneColor": scene.color,
+        "locationId": scene.location_id,
+    }
+
+
+def same_devices(current: Iterable[DeviceEntity], fresh: Iterable[DeviceEntity]) -> bool:
+    '''True when both have the same devices with the same capabilities'''
+    def layout(devices: Iterable[DeviceEntity]):
+        return {device.device_id: (tuple(device.capabilities),
+                                   tuple(sorted((key, tuple(value)) for key, value in device.components.items())))
+                for device in devices}
+    return layout(current) == layout(fresh)
+
+
+class DeviceSnapshot():
+    '''Devices, statuses and scenes of a location as last seen'''
+
+    def __init__(self, hass: HomeAssistant, location_id: str) -> None:
+        self._store = Store(hass, STORAGE_VERSION, f"{_location_storage_key(location_id)}.devices")
+        self._save_scheduled = False
+
+    async def load(self, api: Any) -> Optional[Tuple[List[DeviceEntity], List[SceneEntity]]]:
+        data = await self._store.async_load()
+        if not data:
+            return None
+        devices = []
+        for device_data in data["devices"]:
+            device = DeviceEntity(api, device_data)
+            device.status.apply_data(device_data["status"])
+            devices.append(device)
+        scenes = [SceneEntity(api, scene_data) for scene_data in data["scenes"]]
+        return devices, scenes
+
+    @staticmethod
+    def _as_dict(devices: Iterable[DeviceEntity], scenes: Iterable[SceneEntity]) -> Dict[str, Any]:
+        return {
+            "devices": [{**device_as_dict(device), "status": status_as_dict(device)} for device in devices],
+            "scenes": [scene_as_dict(scene) for scene in scenes],
+        }
+
+    async def save(self, devices: Iterable[DeviceEntity], scenes: Iterable[SceneEntity]):
+        await self._store.async_save(self._as_dict(devices, scenes))
+
+    def schedule_save(self, broker: Any):
+        '''Save the broker's devices after a while, coalescing updates'''
+        if self._save_scheduled:
+            # rescheduling would keep postponing the save while events flow
+            return
+        self._save_scheduled = True
+
+        def data() -> Dict[str, Any]:
+            self._save_scheduled = False
+            return self._as_dict(broker.devices.values(), broker.scenes.values())
+
+        self._store.async_delay_save(data, SNAPSHOT_SAVE_DELAY)
+
+    async def remove(self):
+        await self._store.async_remove()
@@ -0,0 +1,35 @@
+"""Device attributes the loaded entities consume."""
+from typing import Any, Dict, List
+
+from homeassistant.config_entries import ConfigEntry
+from homeassistant.core import HomeAssistant
+from homeassistant.helpers import entity_registry as er
+from pysmartthings import Attribute, Capability
+from pysmartthings.capability import CAPABILITIES_TO_ATTRIBUTES
+
+# platforms whose entities are per attribute, with "<device id>.<attribute>" unique ids
+_ATTRIBUTE_PLATFORMS = ("binary_sensor", "sensor")
+
+
+def consumed_attributes(hass: HomeAssistant, entry: ConfigEntry, broker: Any) -> Dict[str, List[str]]:
+    '''Attributes of each device mapped by an enabled entity'''
+    registry = er.async_get(hass)
+    disabled = {(entity.domain, entity.unique_id)
+                for entity in er.async_entries_for_config_entry(registry, entry.entry_id)
+                if entity.disabled_by}
+    subscriptions = {}
+    for device_id, slots in broker._assignments.items():
+        attributes = set()
+        for capability, platform in slots.items():
+            names = CAPABILITIES_TO_ATTRIBUTES.get(capability, [])
+            if platform in _ATTRIBUTE_PLATFORMS:
+                attributes.update(name for name in names
+                                  if (platform, f"{device_id}.{name}") not in disabled)
+            elif (platform, device_id) not in disabled:
+                attributes.update(names)
+        device = broker.devices.get(device_id)
+        if device and Capability.button in device.capabilities:
+            # fired on the event bus for automations, no entity maps it
+            attributes.add(Attribute.button)
+        subscriptions[device_id] = sorted(attributes)
+    return subscriptions
@@ -0,0 +1,137 @@
+"""Rate limit chatty device attributes received on LAN."""
+import asyncio
+import logging
+import time
+from typing import Any, Callable, Dict, List, Mapping, NamedTuple, Optional, Tuple
+
+from .const import CONF_DELTA, CONF_MIN_INTERVAL, CONF_PASS_STATE_CHANGES, THROTTLE_RULES
+from .events import LanEvent
+
+FlushEvents = Callable[[List[LanEvent]], None]
+_LOGGER = logging.getLogger(__name__)
+
+
+class ThrottleRule(NamedTuple):
+    min_interval: float = 0.0
+    delta: Optional[float] = None
+    pass_state_changes: bool = False
+
+
+# (device id or None for every device, attribute) -> rule
+ThrottleRules = Mapping[Tuple[Optional[str], str], ThrottleRule]
+
+
+def default_rules() -> Dict[Tuple[Optional[str], str], ThrottleRule]:
+    return {(None, attribute): ThrottleRule(rule.get(CONF_MIN_INTERVAL, 0.0), rule.get(CONF_DELTA),
+                                            rule.get(CONF_PASS_STATE_CHANGES, False))
+            for attribute, rule in THROTTLE_RULES.items()}
+
+
+def _is_number(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class _AttributeState():
+    __slots__ = ("sent_at", "value", "pending", "timer")
+
+    def __init__(self) -> None:
+        self.sent_at = 0.0
+        self.value: Any = None
+        self.pending: Optional[LanEvent] = None
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class EventThrottle():
+    '''Suppress reports of an attribute that come too often or change too little.
+
+    An event passes when ``min_interval`` seconds have gone by since the last
+    one that passed and, for numbers, its value moved by at least ``delta``
+    from that one. With ``pass_state_changes`` events flagged as a state
+    change always pass. The latest event suppressed by the interval is sent
+    through ``flush`` when the interval ends, if it still differs enough.
+    Attributes without a rule are not throttled.
+    '''
+
+    def __init__(self, flush: FlushEvents, rules: Optional[ThrottleRules] = None) -> None:
+        self._flush = flush
+        self._rules: ThrottleRules = default_rules() if rules is None else rules
+        self._attributes = frozenset(attribute for _, attribute in self._rules)
+        self._states: Dict[Tuple[str, str], _AttributeState] = {}
+        self.suppressed: Dict[str, int] = {}
+        self.flushed = 0
+
+    def set_rules(self, rules: ThrottleRules):
+        self.close()
+        self._rules = rules
+        self._attributes = frozenset(attribute for _, attribute in rules)
+
+    def _rule(self, evt: LanEvent) -> Optional[ThrottleRule]:
+        rules = self._rules
+        return rules.get((evt.device_id, evt.attribute)) or rules.get((None, evt.attribute))
+
+    @staticmethod
+    def _moved(rule: ThrottleRule, state: _AttributeState, value: Any) -> bool:
+        if rule.delta is None or not _is_number(value) or not _is_number(state.value):
+            return value != state.value
+        return abs(value - state.value) >= rule.delta
+
+    def filter(self, events: List[LanEvent]) -> List[LanEvent]:
+        attributes = self._attributes
+        if not any(evt.attribute in attributes for evt in events):
+            return events
+        now = time.monotonic()
+        return [evt for evt in events if self._accept(evt, now)]
+
+    def _accept(self, evt: LanEvent, now: float) -> bool:
+        if evt.attribute not in self._attributes:
+            return True
+        rule = self._rule(evt)
+        if rule is None:
+            return True
+        key = (evt.device_id, evt.attribute)
+        state = self._states.get(key)
+        if state is None:
+            state = self._states[key] = _AttributeState()
+        elif not (rule.pass_state_changes and evt.state_change):
+            if now - state.sent_at < rule.min_interval:
+                state.pending = evt
+                if state.timer is None:
+                    state.timer = asyncio.get_running_loop().call_later(
+                        state.sent_at + rule.min_interval - now, self._trailing, key, rule)
+                self._suppress(evt)
+                return False
+            if not self._moved(rule, state, evt.value):
+                self._suppress(evt)
+                return False
+        self._sent(state, evt, now)
+        return True
+
+    def _suppress(self, evt: LanEvent):
+        self.suppressed[evt.attribute] = self.suppressed.get(evt.attribute, 0) + 1
+
+    @staticmethod
+    def _sent(state: _AttributeState, evt: LanEvent, now: float):
+        state.sent_at = now
+        state.value = evt.value
+        state.pending = None
+        if state.timer:
+            state.timer.cancel()
+            state.timer = None
+
+    def _trailing(self, key: Tuple[str, str], rule: ThrottleRule):
+        state = self._states.get(key)
+        if state is None:
+            return
+        state.timer = None
+        evt, state.pending = state.pending, None
+        if evt is None or not self._moved(rule, state, evt.value):
+            return
+        self._sent(state, evt, time.monotonic())
+        self.flushed += 1
+        self._flush([evt])
+
+    def close(self):
+        for state in self._states.values():
+            if state.timer:
+                state.timer.cancel()
+        self._states.clear()
@@ -0,0 +1,197 @@
+"""Benchmark Hub against the local fake hub, in-process.
+
+Starts a minimal Home Assistant (http + webhook) and a FakeHub, registers a
+Hub with it and measures:
+
+- ingest: LAN events per second through webhook_handler and the event queue
+- commands: execute_command latency until the hub acknowledges, with many
+  concurrent callers
+- soak: traced memory while events keep flowing for a while
+
+Run from the repository root inside the project virtual env:
+
+    python scripts/bench_hub.py [--events N] [--concurrency C] [--soak SECONDS]
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Dict, List
+from uuid import uuid4
+
+from homeassistant.components import webhook
+from homeassistant.config_entries import ConfigEntries
+from homeassistant.core import HomeAssistant
+from homeassistant.setup import async_setup_component
+from pysmartthings import DeviceEntity
+
+from fake_hub import FakeHub
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "ha_config"))
+from custom_components.lan_smartthings.const import PATH_LAN  # noqa: E402
+from custom_components.lan_smartthings.hub import Hub, HubInfo, HubRegistry  # noqa: E402
+from custom_components.lan_smartthings.retry import HubError  # noqa: E402
+
+
+class BenchBroker():
+    '''Holds the devices the hub applies events to'''
+
+    def __init__(self, devices: List[DeviceEntity]) -> None:
+        self.devices = {device.device_id: device for device in devices}
+
+    async def _event_handler(self, req, resp, app):
+        pass
+
+
+def make_devices(count: int, location_id: str) -> List[DeviceEntity]:
+    return [DeviceEntity(None, {
+        "deviceId": str(uuid4()),
+        "name": f"light{index}",
+        "label": f"Light {index}",
+        "locationId": location_id,
+        "type": "DTH",
+        "components": [{"id": "main", "capabilities": [{"id": "switch"}, {"id": "switchLevel"}]}],
+        "dth": {"deviceTypeId": "", "deviceTypeName": "", "deviceNetworkType": ""},
+    }) for index in range(count)]
+
+
+async def start_hass(config_dir: str) -> HomeAssistant:
+    hass = HomeAssistant()
+    hass.config.config_dir = config_dir
+    hass.config.skip_pip = True
+    # components set up without bootstrap still expect the config entries
+    hass.config_entries = ConfigEntries(hass, {})
+    await hass.config_entries.async_initialize()
+    await async_setup_component(hass, "http", {"http": {"server_host": "127.0.0.1", "server_port": 18123}})
+    await async_setup_component(hass, "webhook", {})
+    await hass.async_start()
+    return hass
+
+
+async def wait_until(predicate, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise TimeoutError()
+        await asyncio.sleep(0.005)
+
+
+async def bench_ingest(hub: Hub, fake: FakeHub, device_ids: List[str], *,
+                       events: int, concurrency: int) -> Dict[str, Any]:
+    received = hub.metrics.events_received[PATH_LAN]
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def emit(index: int):
+        async with semaphore:
+            await fake.emit(device_ids[index % len(device_ids)], "level", index % 100)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(emit(index) for index in range(events)))
+    await wait_until(lambda: hub.metrics.events_received[PATH_LAN] - received >= events
+                     and hub.event_queue.depth == 0)
+    elapsed = time.perf_counter() - start
+    return {"events": events, "seconds": elapsed, "events_per_second": events / elapsed,
+            "max_queue_depth": hub.event_queue.max_depth, "dropped": hub.event_queue.dropped}
+
+
+async def bench_commands(hub: Hub, device_ids: List[str], *,
+                         commands: int, concurrency: int) -> Dict[str, Any]:
+    '''Latency until the hub acknowledged each command, at most concurrency awaiting it'''
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    failed = 0
+
+    async def command(index: int):
+        nonlocal failed
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await hub.execute_command(device_ids[index % len(device_ids)], "setLevel", [index % 100],
+                                          wait=True)
+            except HubError:
+                failed += 1
+                return
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(command(index) for index in range(commands)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    queue = hub.command_queue
+    return {"commands": commands, "failed": failed, "seconds": elapsed,
+            "p50": statistics.median(latencies), "p95": latencies[int(len(latencies) * 0.95) - 1],
+            "max": latencies[-1], "sent": queue.sent, "batches": queue.batches, "merged": queue.merged,
+            "rtt": hub.metrics.command_rtt.as_dict(), "ack": hub.metrics.command_ack.as_dict()}
+
+
+async def bench_soak(hub: Hub, fake: FakeHub, device_ids: List[str], *,
+                     seconds: float, rate: int) -> Dict[str, Any]:
+    tracemalloc.start()
+    samples: List[int] = []
+    index = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        tick = time.monotonic()
+        await asyncio.gather(*(fake.emit(device_ids[(index + n) % len(device_ids)], "level", n % 100)
+                               for n in range(rate)))
+        index += rate
+        samples.append(tracemalloc.get_traced_memory()[0])
+        await asyncio.sleep(max(0.0, 1.0 - (time.monotonic() - tick)))
+    tracemalloc.stop()
+    return {"seconds": seconds, "events": index,
+            "memory_start_kib": samples[0] / 1024, "memory_end_kib": samples[-1] / 1024,
+            "memory_max_kib": max(samples) / 1024}
+
+
+async def run(args) -> Dict[str, Any]:
+    fake = FakeHub(command_delay=args.command_delay)
+    await fake.start()
+    with tempfile.TemporaryDirectory() as config_dir:
+        hass = await start_hass(config_dir)
+        info = HubInfo(hass=hass, lan_webhook_id=webhook.async_generate_id(),
+                       hub_url=fake.url, hub_ip=fake.host,
+                       hub_id=str(uuid4()), location_id=fake.location_id,
+                       targeturl_base="https://localhost/relay?access_token=",
+                       cloud_webhook_id=webhook.async_generate_id(),
+                       access_token="", instance_id=str(uuid4()))
+        hub = Hub(hass, info=info)
+        await hub.register()
+        devices = make_devices(args.devices, fake.location_id)
+        broker = BenchBroker(devices)
+        registry = HubRegistry()
+        hub.start(broker, str(uuid4()), registry)
+        registry.add("bench", fake.location_id, broker, [hub])
+        device_ids = [device.device_id for device in devices]
+        results = {
+            "ingest": await bench_ingest(hub, fake, device_ids, events=args.events, concurrency=args.concurrency),
+            "commands": await bench_commands(hub, device_ids, commands=args.commands, concurrency=args.concurrency),
+        }
+        if args.soak:
+            results["soak"] = await bench_soak(hub, fake, device_ids, seconds=args.soak, rate=args.rate)
+        results["diagnostics"] = hub.diagnostics()
+        await hub.stop()
+        await hass.async_stop()
+    await fake.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser("bench_hub")
+    parser.add_argument("--devices", type=int, default=50)
+    parser.add_argument("--events", type=int, default=5000)
+    parser.add_argument("--commands", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--command-delay", type=float, default=0.01)
+    parser.add_argument("--soak", type=float, default=0, help="seconds, 0 to skip")
+    parser.add_argument("--rate", type=int, default=50, help="events per second during soak")
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), indent=2, default=str))
+
+
+if __name__ == "__main__":
+    main()
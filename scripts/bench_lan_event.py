@@ -0,0 +1,172 @@
+"""Benchmark of LAN event dispatch: broker handler vs Hub._dispatch.
+
+Both paths apply the same batches of LAN events to the status of broker
+devices and send one update signal per batch to a connected listener:
+
+- EventRequest: the path used before, the hub wrapped a batch into a
+  synthetic EventRequest and awaited the SmartThings DeviceBroker handler
+- LanEvent: the batch is parsed into LanEvent records and applied by
+  Hub._dispatch
+
+Prints CPU time and peak traced memory per event.
+
+Run from the repository root inside the project virtual env:
+
+    python scripts/bench_lan_event.py [--events N] [--batch B] [--devices D]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+from typing import Any, Dict, List
+from uuid import uuid4
+
+from homeassistant.components import webhook
+from homeassistant.components.smartthings import DeviceBroker
+from homeassistant.components.smartthings.const import CONF_INSTALLED_APP_ID
+from homeassistant.components.smartthings.const import SIGNAL_SMARTTHINGS_UPDATE as BROKER_SIGNAL
+from homeassistant.core import HomeAssistant, callback
+from homeassistant.helpers.dispatcher import async_dispatcher_connect
+from pysmartapp.const import EVENT_TYPE_DEVICE
+from pysmartapp.event import EventRequest
+
+from bench_hub import make_devices
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "ha_config"))
+from custom_components.lan_smartthings.const import SIGNAL_SMARTTHINGS_UPDATE  # noqa: E402
+from custom_components.lan_smartthings.events import LanEvent  # noqa: E402
+from custom_components.lan_smartthings.hub import Hub, HubInfo, HubRegistry  # noqa: E402
+
+LOCATION_ID = str(uuid4())
+INSTALLED_APP_ID = str(uuid4())
+
+
+def lan_batches(device_ids: List[str], events: int, batch: int) -> List[List[Dict[str, Any]]]:
+    payloads = [{
+        "eventId": str(uuid4()),
+        "locationId": LOCATION_ID,
+        "deviceId": device_ids[index % len(device_ids)],
+        "attribute": "level" if index % 2 else "switch",
+        "value": index % 100 if index % 2 else "on",
+        "data": None,
+        "stateChange": True,
+        "time": 1628000000000 + index,
+    } for index in range(events)]
+    return [payloads[start:start + batch] for start in range(0, events, batch)]
+
+
+def event_request(lan_events: List[Dict[str, Any]]) -> EventRequest:
+    '''The request the hub built for a batch of LAN events before'''
+    return EventRequest({
+        'lifecycle': "",
+        'executionId': "",
+        'locale': "",
+        'version': "",
+        'settings': "",
+        "eventData": {
+            "authToken": "",
+            "installedApp": {
+                'installedAppId': INSTALLED_APP_ID,
+                'locationId': lan_events[0]["locationId"],
+                'config': "",
+            },
+            "events": [
+                {
+                    'eventType': EVENT_TYPE_DEVICE,
+                    "deviceEvent": {
+                        'subscriptionName': "",
+                        'eventId': json_data["eventId"],
+                        'locationId': json_data["locationId"],
+                        'deviceId': json_data["deviceId"],
+                        'componentId': "main",
+                        'capability': "",
+                        'attribute': json_data["attribute"],
+                        'value': json_data["value"],
+                        'valueType': "",
+                        'data': json_data["data"],
+                        'stateChange': json_data["stateChange"]
+                    },
+                } for json_data in lan_events],
+        },
+    })
+
+
+async def measure(run, batches, events: int, repeat: int = 5):
+    best = None
+    for _ in range(repeat):
+        started = time.process_time()
+        await run(batches)
+        elapsed = time.process_time() - started
+        best = elapsed if best is None else min(best, elapsed)
+        await asyncio.sleep(0)  # let the listener handle the signals
+    # the devices already hold every attribute, so the peak is what handling one batch allocates
+    tracemalloc.start()
+    await run(batches[:1])
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    await asyncio.sleep(0)
+    return best / events, peak / len(batches[0])
+
+
+async def _bench(args):
+    with tempfile.TemporaryDirectory() as config_dir:
+        hass = HomeAssistant()
+        hass.config.config_dir = config_dir
+        signals = []
+
+        @callback
+        def entities_update(device_ids):
+            signals.append(device_ids)
+        # the SmartThings broker sends the signal of the core integration
+        for signal in (BROKER_SIGNAL, SIGNAL_SMARTTHINGS_UPDATE):
+            async_dispatcher_connect(hass, signal, entities_update)
+
+        devices = make_devices(args.devices, LOCATION_ID)
+        entry = SimpleNamespace(data={CONF_INSTALLED_APP_ID: INSTALLED_APP_ID})
+        broker = DeviceBroker(hass, entry, None, None, devices, [])
+        info = HubInfo(hass=hass, lan_webhook_id=webhook.async_generate_id(),
+                       hub_url="http://127.0.0.1:39500", hub_ip="127.0.0.1", mac=None,
+                       hub_id=str(uuid4()), location_id=LOCATION_ID,
+                       targeturl_base="https://localhost/relay?access_token=",
+                       cloud_webhook_id=webhook.async_generate_id(),
+                       access_token="", instance_id=str(uuid4()))
+        hub = Hub(hass, info=info)
+        registry = HubRegistry()
+        registry.add("bench", LOCATION_ID, broker, [hub])
+        # what Hub.start sets, without registering the webhook and the hub
+        hub._registry = registry
+
+        async def via_event_request(batches):
+            for lan_events in batches:
+                await broker._event_handler(event_request(lan_events), None, None)
+
+        async def via_lan_event(batches):
+            for lan_events in batches:
+                hub._dispatch([LanEvent(json_data) for json_data in lan_events])
+
+        batches = lan_batches(list(broker.devices), args.events, args.batch)
+        print(f"{args.events} events in batches of {args.batch} over {args.devices} devices")
+        print(f"{'path':<16}{'us/event':>10}{'bytes/event':>14}")
+        for name, run in (("EventRequest", via_event_request), ("LanEvent", via_lan_event)):
+            signals.clear()
+            per_event, peak = await measure(run, batches, args.events)
+            assert len(signals) == 5 * len(batches) + 1, name
+            print(f"{name:<16}{per_event * 1e6:>10.2f}{peak:>14.0f}")
+        await hass.async_stop(force=True)
+
+
+def main():
+    parser = argparse.ArgumentParser("bench_lan_event")
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--batch", type=int, default=10)
+    parser.add_argument("--devices", type=int, default=50)
+    args = parser.parse_args()
+    asyncio.run(_bench(args))
+
+
+if __name__ == "__main__":
+    main()
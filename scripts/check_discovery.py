@@ -0,0 +1,98 @@
+"""Check that a hub found by discovery at a new address is followed.
+
+Starts a minimal Home Assistant with the integration set up and a FakeHub,
+registers a Hub with it, then moves the fake hub to another loopback address
+and starts DHCP discovery flows for it. The flows go through the config flow's
+async_step_dhcp and the integration's discovery signal to the hub. Prints how
+long the hub took to re-register at the new address.
+
+Run from the repository root inside the project virtual env:
+
+    python scripts/check_discovery.py
+"""
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from uuid import uuid4
+
+from homeassistant import config_entries
+from homeassistant.components import webhook
+from homeassistant.setup import async_setup_component
+
+from bench_hub import BenchBroker, start_hass, wait_until
+from fake_hub import FakeHub
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "ha_config"))
+from custom_components.lan_smartthings import _get_registry  # noqa: E402
+from custom_components.lan_smartthings.const import DOMAIN  # noqa: E402
+from custom_components.lan_smartthings.hub import Hub, HubInfo, discovered_hub  # noqa: E402
+
+MAC = "24:FD:5B:00:12:34"
+MOVED_HOST = "127.0.0.2"
+
+
+def _dhcp(host: str, mac: str = MAC):
+    return {"ip": host, "hostname": "hub", "macaddress": mac.replace(":", "").lower()}
+
+
+async def _discover(hass, payload):
+    result = await hass.config_entries.flow.async_init(
+        DOMAIN, context={"source": config_entries.SOURCE_DHCP}, data=payload)
+    assert result["type"] == "abort", result
+    await hass.async_block_till_done()
+
+
+async def _check():
+    assert discovered_hub({"ip": MOVED_HOST, "hostname": "hub"}) is None
+    assert discovered_hub(_dhcp(MOVED_HOST)) == (MOVED_HOST, "24fd5b001234")
+
+    fake = FakeHub()
+    await fake.start()
+    results = {}
+    with tempfile.TemporaryDirectory() as config_dir:
+        hass = await start_hass(config_dir)
+        await async_setup_component(hass, "persistent_notification", {})
+        assert await async_setup_component(hass, DOMAIN, {})
+        info = HubInfo(hass=hass, lan_webhook_id=webhook.async_generate_id(),
+                       hub_url=fake.url, hub_ip=fake.host, mac=MAC,
+                       hub_id=str(uuid4()), location_id=fake.location_id,
+                       targeturl_base="https://localhost/relay?access_token=",
+                       cloud_webhook_id=webhook.async_generate_id(),
+                       access_token="", instance_id=str(uuid4()))
+        hub = Hub(hass, info=info)
+        # the registry the integration keeps for its loaded entries
+        registry = _get_registry(hass)
+        hub.start(BenchBroker([]), str(uuid4()), registry)
+        registry.add("check", fake.location_id, BenchBroker([]), [hub])
+        await wait_until(lambda: hub.lan_ready)
+
+        # another device with a SmartThings OUI leaves the hub where it is
+        await _discover(hass, _dhcp(MOVED_HOST, "24:FD:5B:FF:FF:FF"))
+        assert hub.hub_ip == fake.host and hub.lan_ready
+        # the hub got another address, the port stays the same
+        await fake.stop()
+        moved = FakeHub(host=MOVED_HOST, port=fake.port, location_id=fake.location_id)
+        await moved.start()
+        started = time.perf_counter()
+        await _discover(hass, _dhcp(MOVED_HOST))
+        await wait_until(lambda: hub.lan_ready and bool(moved.subscribers), timeout=10.0)
+        results["dhcp"] = {"hub_ip": hub.hub_ip, "reregistered_s": round(time.perf_counter() - started, 3)}
+        # the same lease seen again is not a move
+        await _discover(hass, _dhcp(MOVED_HOST))
+        assert hub.lan_ready and len(moved.subscribers) == 1
+        results["diagnostics"] = {key: hub.diagnostics()[key] for key in ("hub_url", "mac", "healthy")}
+        await hub.stop()
+        await hass.async_stop()
+        await moved.stop()
+    print(json.dumps(results, indent=2))
+
+
+def main():
+    asyncio.run(_check())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""Local stand-in for the SmartThings IDE pages crawled by classic_smartapps.
+
+Serves the recorded fixtures in scripts/fixtures/classic_smartapps: the
+location list, the installations of each shard server and the installed
+SmartApp state page. Every request waits `--delay` seconds like the real
+servers do, and a state page is only served by the server that lists the app.
+
+Run from the repository root inside the project virtual env to check
+classic_smartapps against it and time a cold and a cached crawl:
+
+    python scripts/fake_graph.py [--delay SECONDS]
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import Counter
+from string import Template
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "ha_config"))
+from custom_components.lan_smartthings.smartapp import classic_smartapps  # noqa: E402
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures", "classic_smartapps")
+
+
+class FakeGraph():
+
+    def __init__(self, *, host: str = "127.0.0.1", port: int = 0,
+                 fixtures: str = FIXTURES, delay: float = 0.0) -> None:
+        self.host = host
+        self.port = port
+        self.delay = delay
+        self.requests: Counter = Counter()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        with open(os.path.join(fixtures, "location_list.html")) as file:
+            self.location_list = file.read()
+        with open(os.path.join(fixtures, "state.html")) as file:
+            self.state = Template(file.read())
+        self.installations: Dict[str, List[Dict[str, Any]]] = {}
+        for name in os.listdir(fixtures):
+            if name.startswith("installations_") and name.endswith(".json"):
+                with open(os.path.join(fixtures, name)) as file:
+                    self.installations[name[len("installations_"):-len(".json")]] = json.load(file)
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    @property
+    def server_url(self) -> str:
+        return self.url + "/{servername}"
+
+    def access_token(self, app_id: str) -> str:
+        return f"token-{app_id}"
+
+    async def start(self):
+        app = web.Application(middlewares=[self._track])
+        app.router.add_get("/location/list", self._location_list)
+        app.router.add_get("/{server}/api/smartapps/installations", self._installations)
+        app.router.add_get("/{server}/installedSmartApp/showModal/{app_id}", self._state)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    @web.middleware
+    async def _track(self, request: web.Request, handler) -> web.StreamResponse:
+        self.requests[request.path] += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.delay:
+                await asyncio.sleep(self.delay)
+            return await handler(request)
+        finally:
+            self.in_flight -= 1
+
+    async def _location_list(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.location_list, content_type="text/html")
+
+    async def _installations(self, request: web.Request) -> web.Response:
+        apps = self.installations.get(request.match_info["server"])
+        if apps is None:
+            raise web.HTTPNotFound()
+        return web.json_response(apps)
+
+    async def _state(self, request: web.Request) -> web.Response:
+        app_id = request.match_info["app_id"]
+        apps = self.installations.get(request.match_info["server"], [])
+        app = next((app for app in apps if app["id"] == app_id), None)
+        if app is None:
+            raise web.HTTPNotFound()
+        text = self.state.substitute(label=app["label"], app_id=app_id,
+                                     access_token=self.access_token(app_id))
+        return web.Response(text=text, content_type="text/html")
+
+
+async def _check(delay: float):
+    graph = FakeGraph(delay=delay)
+    await graph.start()
+    try:
+        async with aiohttp.ClientSession() as session:
+            def crawl():
+                return classic_smartapps(session, "token", location_list=graph.url + "/location/list",
+                                         server_url=graph.server_url)
+            started = time.perf_counter()
+            apps = await crawl()
+            cold = time.perf_counter() - started
+            started = time.perf_counter()
+            cached = await crawl()
+            warm = time.perf_counter() - started
+    finally:
+        await graph.stop()
+    expected = [app for listed in graph.installations.values() for app in listed
+                if app["smartAppVersion"]["name"] == "Home Assistant Relay"]
+    assert sorted(app["id"] for app in apps.apps) == sorted(app["id"] for app in expected)
+    for app in expected:
+        assert apps.properties[app["id"]]["accessToken"] == graph.access_token(app["id"]), app["id"]
+    assert len(apps.servers) == 3
+    assert cached is apps
+    print(json.dumps({
+        "apps": len(apps.apps),
+        "requests": sum(graph.requests.values()),
+        "max_in_flight": graph.max_in_flight,
+        "cold_s": round(cold, 3),
+        "cached_s": round(warm, 6),
+    }, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser("fake_graph")
+    parser.add_argument("--delay", type=float, default=0.2,
+                        help="seconds every request to the stand-in takes")
+    args = parser.parse_args()
+    asyncio.run(_check(args.delay))
+
+
+if __name__ == "__main__":
+    main()
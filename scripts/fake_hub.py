@@ -0,0 +1,191 @@
+"""Local stand-in for a SmartThings hub running the Home Assistant Relay SmartApp.
+
+Implements the LAN protocol of smartapp.groovy: the register/command/
+commands/ping/forwarding/unregister actions, the accessToken callback and event POSTs back
+to every registered Home Assistant instance. Commands are executed one after
+another like the hub does. A request answers the instance that sent it with
+the acks of its commands, then all instances get the matching events.
+
+Run standalone to point a development Home Assistant at it:
+
+    python scripts/fake_hub.py --port 39500
+"""
+import argparse
+import asyncio
+import logging
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+from uuid import uuid4
+
+import aiohttp
+from aiohttp import hdrs, web
+
+_LOGGER = logging.getLogger(__name__)
+
+USER_AGENT = "HA ST Link/1.0"
+SUBSCRIBER_LEASE = 300.0
+
+# command -> (attribute, value from args)
+COMMAND_EVENTS = {
+    "on": ("switch", lambda args: "on"),
+    "off": ("switch", lambda args: "off"),
+    "setLevel": ("level", lambda args: args[0]),
+    "lock": ("lock", lambda args: "locked"),
+    "unlock": ("lock", lambda args: "unlocked"),
+}
+
+
+class FakeHub():
+
+    def __init__(self, *, host: str = "127.0.0.1", port: int = 0,
+                 location_id: Optional[str] = None, command_delay: float = 0.0) -> None:
+        self.host = host
+        self.port = port
+        self.location_id = location_id or str(uuid4())
+        self.command_delay = command_delay
+        self.access_token = str(uuid4())
+        # instance id -> host, path, forward_path, attributes, expires, forward_paused_until
+        self.subscribers: Dict[str, Dict[str, Any]] = {}
+        self.actions: Counter = Counter()
+        self.commands: List[Dict[str, Any]] = []
+        self._runner: Optional[web.AppRunner] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._work: "asyncio.Queue[Tuple[str, List[Dict[str, Any]], bool]]" = asyncio.Queue()
+        self._worker: Optional["asyncio.Task[None]"] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/", self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        self._session = aiohttp.ClientSession()
+        self._worker = asyncio.create_task(self._run_commands())
+
+    async def stop(self):
+        if self._worker:
+            self._worker.cancel()
+        if self._session:
+            await self._session.close()
+        if self._runner:
+            await self._runner.cleanup()
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        if USER_AGENT not in request.headers.get(hdrs.USER_AGENT, ""):
+            return web.Response(status=400)
+        action = request.headers.get("Action")
+        instance = request.headers.get("Instance", "")
+        # unregister comes without a body
+        data = await request.json() if request.body_exists else {}
+        self.actions[action] += 1
+        now = asyncio.get_running_loop().time()
+        subscriber = self.subscribers.get(instance)
+        if subscriber:
+            subscriber["expires"] = now + subscriber["lease"]
+        if action == "register":
+            lease = data.get("lease") or SUBSCRIBER_LEASE
+            self.subscribers[instance] = {
+                "host": data["host"], "path": data["path"], "forward_path": data["forward_path"],
+                "attributes": data.get("attributes"), "lease": lease, "expires": now + lease,
+                "forward_paused_until": 0.0,
+            }
+            asyncio.create_task(self.reply(instance, {"accessToken": self.access_token}))
+        elif action == "command":
+            self._work.put_nowait((instance, [data], False))
+        elif action == "commands":
+            self._work.put_nowait((instance, data["commands"], True))
+        elif action == "ping":
+            asyncio.create_task(self.reply(instance, {"pong": data["id"]}))
+        elif action == "forwarding" and subscriber:
+            pause = data.get("pause")
+            subscriber["forward_paused_until"] = now + pause if pause else 0.0
+        elif action == "unregister":
+            self.subscribers.pop(instance, None)
+        return web.Response(status=202)
+
+    async def _run_commands(self):
+        while True:
+            instance, commands, batched = await self._work.get()
+            acks = []
+            for command in commands:
+                self.commands.append(command)
+                if self.command_delay:
+                    await asyncio.sleep(self.command_delay)
+                if command.get("id") is not None:
+                    acks.append({"id": command["id"], "ok": True})
+            if batched and acks:
+                await self.reply(instance, {"acks": acks})
+            elif acks:
+                await self.reply(instance, {"ack": acks[0]})
+            for command in commands:
+                mapping = COMMAND_EVENTS.get(command["command"])
+                if mapping:
+                    attribute, value = mapping
+                    await self.emit(command["device_id"], attribute, value(command.get("args")))
+
+    def event(self, device_id: str, attribute: str, value: Any) -> Dict[str, Any]:
+        return {
+            "eventId": str(uuid4()),
+            "locationId": self.location_id,
+            "deviceId": device_id,
+            "attribute": attribute,
+            "value": value,
+            "data": None,
+            "stateChange": True,
+            "time": int(time.time() * 1000),
+        }
+
+    async def emit(self, device_id: str, attribute: str, value: Any):
+        await self.post({"event": self.event(device_id, attribute, value)})
+
+    async def emit_batch(self, events: List[Dict[str, Any]]):
+        await self.post({"events": events})
+
+    def live_subscribers(self) -> Dict[str, Dict[str, Any]]:
+        now = asyncio.get_running_loop().time()
+        self.subscribers = {instance: subscriber for instance, subscriber in self.subscribers.items()
+                            if subscriber["expires"] > now}
+        return self.subscribers
+
+    async def post(self, body: Dict[str, Any]):
+        '''Post to every live instance, like events are fanned out'''
+        await asyncio.gather(*(self.reply(instance, body) for instance in self.live_subscribers()))
+
+    async def reply(self, instance: str, body: Dict[str, Any]):
+        subscriber = self.subscribers.get(instance)
+        if not subscriber or not self._session:
+            return
+        async with self._session.post(f"http://{subscriber['host']}{subscriber['path']}", json=body) as resp:
+            await resp.read()
+
+
+async def _serve(host: str, port: int, command_delay: float):
+    hub = FakeHub(host=host, port=port, command_delay=command_delay)
+    await hub.start()
+    _LOGGER.info("Fake hub listening on %s", hub.url)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await hub.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser("fake_hub")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=39500)
+    parser.add_argument("--command-delay", type=float, default=0.05,
+                        help="seconds the hub takes to execute a command")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_serve(args.host, args.port, args.command_delay))
+
+
+if __name__ == "__main__":
+    main()
@@ -91,6 +91,11 @@ mappings {
 			POST: "relay_post"
 		]
 	}
+	path("/hubs") {
+		action: [
+			GET: "hubs_get"
+		]
+	}
 	
 }
 preferences {
@@ -103,6 +108,10 @@ preferences {
     	paragraph "Events receive from cloud are forwarded to Home Assistant. You can enable or disable it. Events captured on LAN are always forwarded."
     	input "forward_events", "bool", title: "Forward", defaultValue: true, required: true
     }
+    section() {
+    	paragraph "Events captured on LAN can be sent in batches to reduce traffic. Set to 0 to send each event immediately."
+    	input "batch_window", "number", title: "Batch window (seconds)", defaultValue: 0, required: false
+    }
     
 }
 
@@ -135,7 +144,93 @@ def initialize() {
     def hub = location.hubs[0]
     log.debug "Hub listening on: ${hub.localIP}:${hub.localSrvPortTCP}"
     subscribe(location,null, lanEventHandler, [filterEvents: false])
-    if(state.host != null) register();
+    runEvery5Minutes(expireSubscribers)
+    if(getSubscribers()) subscribeAttributes();
+}
+
+// HA instances registered on LAN, by instance id. Each one expires unless it
+// keeps talking to the hub, its health pings renew it.
+def getSubscribers()
+{
+  def subscribers = state.subscribers
+  if (subscribers == null) {
+    subscribers = [:]
+    if (state.host != null) {
+      // registered by a single instance before
+      subscribers[""] = [host: state.host, path: state.path, forward_path: state.forward_path,
+                         attributes: state.subscribed, lease: 300, expires: now() + 300000, forward_paused_until: 0]
+      state.host = null
+      state.path = null
+      state.forward_path = null
+      state.subscribed = null
+    }
+    state.subscribers = subscribers
+  }
+  return subscribers
+}
+
+def liveSubscribers()
+{
+  def time = now()
+  return getSubscribers().findAll { id, subscriber -> subscriber.expires > time }
+}
+
+def expireSubscribers()
+{
+  def subscribers = getSubscribers()
+  def live = liveSubscribers()
+  if (live.size() == subscribers.size()) return
+  log.debug "Subscribers expired: ${subscribers.keySet() - live.keySet()}"
+  state.subscribers = live
+  subscribeAttributes()
+}
+
+// posts back to the instance that sent the request
+def reply(id, body)
+{
+  def subscriber = getSubscribers()[id]
+  if (subscriber) postData(subscriber.host, subscriber.path, body)
+}
+
+// posts events to every live instance, only those of attributes it subscribed to
+def fanOut(events)
+{
+  liveSubscribers().each { id, subscriber ->
+    def wanted = subscriber.attributes == null ? events
+      : events.findAll { data -> subscriber.attributes[data.deviceId]?.contains(data.attribute) }
+    if (wanted.size() == 1) postData(subscriber.host, subscriber.path, [event: wanted[0]])
+    else if (wanted) postData(subscriber.host, subscriber.path, [events: wanted])
+  }
+}
+
+// forwards a cloud lifecycle request to every live instance
+def forwardAll(body)
+{
+  liveSubscribers().each { id, subscriber -> postData(subscriber.host, subscriber.forward_path, body) }
+}
+
+// forwards cloud events, without those an instance that paused forwarding gets on LAN
+def forwardEvents(body)
+{
+  def time = now()
+  def devices = null
+  liveSubscribers().each { id, subscriber ->
+    if (time >= (subscriber.forward_paused_until ?: 0)) {
+      postData(subscriber.host, subscriber.forward_path, body)
+      return
+    }
+    if (devices == null) devices = getDevices()
+    def events = body.eventData?.events?.findAll { event -> !onLan(subscriber, devices, event) }
+    if (events) postData(subscriber.host, subscriber.forward_path, body + [eventData: body.eventData + [events: events]])
+  }
+}
+
+// true when handleEvt also sends the cloud event to the instance
+def onLan(subscriber, devices, event)
+{
+  def deviceEvent = event.deviceEvent
+  if (deviceEvent == null || devices[deviceEvent.deviceId] == null) return false
+  return subscriber.attributes == null || subscriber.attributes[deviceEvent.deviceId]?.contains(deviceEvent.attribute)
 }
 
 def lanEventHandler(evt)
@@ -145,40 +240,92 @@ def lanEventHandler(evt)
   if (msg.header?.contains("HA ST Link/1.0") && msg.header?.startsWith('POST ')) 
   {
     def data = msg.json
+    def id = msg.headers.Instance ?: ""
+    def subscribers = getSubscribers()
+    def subscriber = subscribers[id]
+    if (subscriber) subscriber.expires = now() + (long)(subscriber.lease * 1000)
     switch(msg.headers.Action)
     {
     case "register":
-      state.host = data.host
-      state.path = data.path
-      state.forward_path = data.forward_path
-      register()
+      def lease = data.lease ?: 300
+      subscribers[id] = [host: data.host, path: data.path, forward_path: data.forward_path,
+                         attributes: data.attributes, lease: lease,
+                         expires: now() + (long)(lease * 1000), forward_paused_until: 0]
+      // keep the list small, the instance heard from least recently goes first
+      if (subscribers.size() > 4) subscribers.remove(subscribers.min { it.value.expires }.key)
+      state.subscribers = subscribers
+      register(id)
       break;
     case "command":
-      def cmd = data.command
-      device = getDevices()[data.device_id]
-      if (data.args == null) device?."$cmd"()
-      else device?."$cmd"(data.args)
+      def ack = runCommand(getDevices(), data)
+      if (ack) reply(id, [ack: ack])
       break;
-    case "unregister":          
-      unsubscribe("handleEvt")
-      state.host = null
-      state.path = null
-      state.forward_path = null
+    case "commands":
+      def devices = getDevices()
+      def acks = data.commands.collect { command -> runCommand(devices, command) }.findAll { it }
+      if (acks) reply(id, [acks: acks])
+      break;
+    case "ping":
+      reply(id, [pong: data.id])
+      break;
+    case "forwarding":
+      // HA receives events on LAN, skip cloud copies for a lease it keeps renewing
+      if (subscriber) subscriber.forward_paused_until = data.pause ? now() + (long)(data.pause * 1000) : 0
+      break;
+    case "unregister":
+      subscribers.remove(id)
+      subscriber = null
+      state.subscribers = subscribers
+      subscribeAttributes()
       break;
     }
+    if (subscriber) state.subscribers = subscribers
   }
 }
 
-def register()
+// returns the ack for commands carrying a correlation id
+def runCommand(devices, data)
 {
-  log.debug "Registered HA Instance from ${state.host}${state.path} with forwarding to ${state.forward_path}"
+  def cmd = data.command
+  def device = devices[data.device_id]
+  def ack = data.id == null ? null : [id: data.id, ok: true]
+  if (device == null) {
+    if (ack) { ack.ok = false; ack.error = "Unknown device ${data.device_id}" }
+    return ack
+  }
+  try {
+    if (data.args == null) device."$cmd"()
+    else device."$cmd"(data.args)
+  }
+  catch (e) {
+    log.debug "Command ${cmd} to ${data.device_id} failed: $e"
+    if (ack) { ack.ok = false; ack.error = "$e" }
+  }
+  return ack
+}
+
+def register(id)
+{
+  def subscriber = getSubscribers()[id]
+  log.debug "Registered HA Instance ${id} from ${subscriber.host}${subscriber.path} with forwarding to ${subscriber.forward_path}"
   if (!state.accessToken) {createAccessToken()}   
-  postData(state.host,state.path,[accessToken: state.accessToken])
-  // Subscribe to all events from devices
+  // HA sends commands for these devices on LAN, the others through cloud
+  reply(id, [accessToken: state.accessToken, devices: getDevices().keySet().collect { "$it" }])
+  subscribeAttributes()
+}
+
+// Subscribe to the attributes the instances use, or all of them if one did not say
+def subscribeAttributes()
+{
   unsubscribe("handleEvt")
+  def subscribers = liveSubscribers().values()
+  if (!subscribers) return
+  def all = subscribers.any { it.attributes == null }
   getDevices().each { id,device  ->
-          device.supportedAttributes.each { attribute ->
-            subscribe(device, attribute.name, handleEvt)
+          def names = all ? device.supportedAttributes*.name
+            : subscribers.collect { it.attributes[id] ?: [] }.flatten().unique()
+          names.each { name ->
+            subscribe(device, name, handleEvt)
               }
           }
 }
@@ -195,9 +342,13 @@ def handleEvt(evt)
             attribute:evt.name,
             value: evt.device?.currentValue(evt.name),
             data: evt.data,
-            stateChange: evt.isStateChange()
+            stateChange: evt.isStateChange(),
+            time: evt.date.time  // lets HA drop events overtaken by newer ones
         ]
-        postData(state.host, state.path,[event: data])
+        def window = settings.batch_window ?: 0
+        // every press counts, only states may wait to be superseded
+        if (window > 0 && evt.name != "button") queueEvent(data, window)
+        else fanOut([data])
         state.lastEventId = "${evt.id}"
         log.debug "Sent event captured on LAN id:${state.lastEventId}"
 	}
@@ -206,6 +357,45 @@ def handleEvt(evt)
 	}
 }
 
+// Events waiting for the batch window. Executions of handleEvt run concurrently,
+// so each device attribute has a slot of its own holding its latest event and no
+// execution rewrites a list another one is appending to.
+def queueEvent(data, window)
+{
+  def key = "pending:${data.deviceId}:${data.attribute}"
+  atomicState[key] = data + [queued: now()]
+  // the index of slots only grows, add the key again if a concurrent write dropped it
+  for (def attempt = 0; attempt < 3; attempt++) {
+    def keys = atomicState.pendingKeys ?: []
+    if (keys.contains(key)) break
+    atomicState.pendingKeys = keys + [key]
+  }
+  if (!atomicState.flushScheduled) {
+    atomicState.flushScheduled = true
+    runIn(window, flushEvents)
+  }
+}
+
+def flushEvents()
+{
+  atomicState.flushScheduled = false
+  def until = now()
+  // slots written just before the last flush may have been missed by it,
+  // they are sent again and HA drops the copies by eventId
+  def since = (atomicState.flushedUntil ?: 0) - 5000
+  atomicState.flushedUntil = until
+  def pending = (atomicState.pendingKeys ?: []).collect { key -> atomicState[key] }
+    .findAll { data -> data && data.queued > since && data.queued <= until }
+  if (pending) fanOut(pending.collect { data -> data.findAll { name, value -> name != "queued" } })
+}
+
+// LAN addresses of the hubs, so HA can find a hub whose IP changed
+def hubs_get()
+{
+  def hubs = location.hubs.collect { hub -> [id: hub.id, localIP: hub.localIP, localSrvPortTCP: hub.localSrvPortTCP] }
+  render contentType: "application/json", data: new JsonBuilder(hubs).toString()
+}
+
 def relay_post()
 {
 	//log.debug "Got request to relay: ${request?.JSON?.lifecycle}"
@@ -219,35 +409,35 @@ def relay_post()
         	def evtid = j?.eventData?.events[0]?.deviceEvent?.eventId
             if(evtid == null || "${state.lastEventId}" != "${evtid}")
             {
-            	postData(state.host,state.forward_path,j)
+            	forwardEvents(j)
         		state.lastEventId = "${evtid}"
             }
            }
         render data: '''{ "eventData": {} }'''
         break
 	case "PING":
-    	postData(state.host,state.forward_path,j)
+    	forwardAll(j)
 		def p = j.pingData
 		render data: new JsonBuilder([pingData:p]).toPrettyString()
         break
  	case "CONFIRMATION":
-    	postData(state.host,state.forward_path,j)
+    	forwardAll(j)
 		render data: new JsonBuilder([targetUrl:state.url]).toPrettyString()
         break
  	case "INSTALL":
-    	postData(state.host,state.forward_path,j)
+    	forwardAll(j)
    		render data: '''{ "installData": {} }'''
         break
 	case "UNINSTALL":
-    	postData(state.host,state.forward_path,j)
+    	forwardAll(j)
    		render data: '''{ "uninstallData": {} }'''
         break
 	case "UPDATE":
-    	postData(state.host,state.forward_path,j)
+    	forwardAll(j)
    		render data: '''{ "updateData": {} }'''
         break
  	case "CONFIGURATION":
-    	postData(state.host,state.forward_path,j)
+    	forwardAll(j)
  		def data = j.configurationData
         switch(data.phase) 
         {
@@ -285,7 +475,7 @@ def relay_post()
        } // phase switch
        break
     default:
-    	postData(state.host,state.forward_path,j)
+    	forwardAll(j)
         render data: null
         break;
  	} // lifecycle switch
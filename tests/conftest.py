@@ -0,0 +1,40 @@
+"""Make the custom component importable like Home Assistant does."""
+import os
+import sys
+from itertools import count
+from typing import Any, Dict
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "ha_config"))
+
+
+@pytest.fixture
+def lan_event():
+    '''Factory of LAN events with unique ids'''
+    from custom_components.lan_smartthings.events import LanEvent
+    ids = count()
+
+    def make(device_id: str = "d1", attribute: str = "switch", value: Any = "on", **extra) -> LanEvent:
+        data: Dict[str, Any] = {
+            "eventId": f"e{next(ids)}",
+            "locationId": "l1",
+            "deviceId": device_id,
+            "attribute": attribute,
+            "value": value,
+            "data": None,
+            "stateChange": True,
+        }
+        data.update(extra)
+        return LanEvent(data)
+    return make
+
+
+@pytest.fixture
+async def hass(tmp_path):
+    '''Home Assistant core without components, storage goes to tmp_path'''
+    from homeassistant.core import HomeAssistant
+    hass = HomeAssistant()
+    hass.config.config_dir = str(tmp_path)
+    yield hass
+    await hass.async_stop(force=True)
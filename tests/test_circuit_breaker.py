@@ -0,0 +1,61 @@
+"""Tests of the retry backoff and the circuit breaker."""
+import pytest
+
+from custom_components.lan_smartthings.retry import (BREAKER_CLOSED, BREAKER_HALF_OPEN, BREAKER_OPEN,
+                                                     CircuitBreaker, HubUnavailable, backoff_delay)
+
+
+def test_breaker_opens_after_threshold():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    breaker.before_request()
+    breaker.record_failure()
+    assert breaker.state == BREAKER_CLOSED
+    breaker.before_request()
+    breaker.record_failure()
+    assert breaker.state == BREAKER_OPEN
+    with pytest.raises(HubUnavailable):
+        breaker.before_request()
+
+
+def test_success_resets_failures():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == BREAKER_CLOSED
+    assert breaker.failures == 1
+
+
+def test_half_open_lets_one_probe_through():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    assert not breaker.before_request()
+    breaker.record_failure()
+    assert breaker.before_request()
+    assert breaker.state == BREAKER_HALF_OPEN
+    with pytest.raises(HubUnavailable):
+        breaker.before_request()
+    breaker.record_success()
+    assert breaker.state == BREAKER_CLOSED
+
+
+def test_failed_probe_reopens():
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=0)
+    for _ in range(3):
+        breaker.record_failure()
+    breaker.before_request()
+    breaker.record_failure()
+    assert breaker.state == BREAKER_OPEN
+
+
+def test_cancelled_probe_is_released():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    breaker.record_failure()
+    breaker.before_request()
+    breaker.cancel_request()
+    breaker.before_request()
+    assert breaker.state == BREAKER_HALF_OPEN
+
+
+def test_backoff_delay_is_capped():
+    for attempt in range(1, 20):
+        assert 0 <= backoff_delay(attempt, base_delay=1, max_delay=5) <= 5
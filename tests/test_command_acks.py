@@ -0,0 +1,49 @@
+"""Tests of the command acknowledgements."""
+import pytest
+
+from custom_components.lan_smartthings.commands import CommandAcks
+from custom_components.lan_smartthings.metrics import HubMetrics
+from custom_components.lan_smartthings.retry import HubError
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_ack_resolves_command():
+    metrics = HubMetrics()
+    acks = CommandAcks(metrics)
+    acks.expect("1")
+    future = acks.get("1")
+    acks.resolve({"id": "1", "ok": True})
+    await future
+    assert acks.acked == 1
+    assert metrics.command_ack.count == 1
+    assert acks.get("1") is None
+
+
+async def test_failed_ack_raises():
+    acks = CommandAcks(HubMetrics())
+    acks.expect("1")
+    future = acks.get("1")
+    acks.resolve({"id": "1", "ok": False, "error": "Unknown device"})
+    with pytest.raises(HubError, match="Unknown device"):
+        await future
+    assert acks.failed == 1
+
+
+async def test_unacknowledged_command_times_out():
+    acks = CommandAcks(HubMetrics(), timeout=0.01)
+    acks.expect("1")
+    with pytest.raises(HubError):
+        await acks.get("1")
+    assert acks.timed_out == 1
+    assert len(acks) == 0
+
+
+async def test_oldest_ack_is_evicted():
+    acks = CommandAcks(HubMetrics(), max_pending=2)
+    for command_id in ("1", "2", "3"):
+        acks.expect(command_id)
+    assert acks.get("1") is None
+    assert acks.evicted == 1
+    assert len(acks) == 2
+    acks.close()
@@ -0,0 +1,96 @@
+"""Tests of the command queue."""
+import asyncio
+
+import pytest
+
+from custom_components.lan_smartthings.commands import CommandQueue
+from custom_components.lan_smartthings.retry import HubError
+
+pytestmark = pytest.mark.asyncio
+
+
+class Recorder():
+    '''Post function recording batches, optionally slow'''
+
+    def __init__(self, delay: float = 0.0) -> None:
+        self.delay = delay
+        self.batches = []
+
+    async def __call__(self, commands):
+        self.batches.append([(c["device_id"], c["command"], c["args"]) for c in commands])
+        if self.delay:
+            await asyncio.sleep(self.delay)
+
+
+async def test_commands_are_batched():
+    post = Recorder()
+    queue = CommandQueue(post)
+    await asyncio.gather(queue.submit("a", "on"), queue.submit("b", "off"))
+    assert post.batches == [[("a", "on", None), ("b", "off", None)]]
+    assert queue.sent == 2
+    assert queue.batches == 1
+
+
+async def test_merged_command_keeps_submission_order():
+    post = Recorder()
+    queue = CommandQueue(post)
+    await asyncio.gather(queue.submit("a", "off"), queue.submit("a", "setLevel", [50]),
+                         queue.submit("a", "off"))
+    assert post.batches == [[("a", "setLevel", [50]), ("a", "off", None)]]
+    assert queue.merged == 1
+
+
+async def test_other_devices_pass_a_device_in_flight():
+    post = Recorder(delay=0.2)
+    queue = CommandQueue(post)
+    first = asyncio.ensure_future(queue.submit("a", "on"))
+    await asyncio.sleep(0.01)
+    held = asyncio.ensure_future(queue.submit("a", "setLevel", [20]))
+    other = asyncio.ensure_future(queue.submit("b", "on"))
+    await asyncio.sleep(0.05)
+    assert post.batches == [[("a", "on", None)], [("b", "on", None)]]
+    await asyncio.gather(first, held, other)
+    assert post.batches[-1] == [("a", "setLevel", [20])]
+
+
+async def test_close_drops_queued_commands():
+    post = Recorder(delay=0.2)
+    queue = CommandQueue(post)
+    first = asyncio.ensure_future(queue.submit("a", "on"))
+    await asyncio.sleep(0.01)
+    queued = asyncio.ensure_future(queue.submit("a", "setLevel", [20]))
+    await asyncio.sleep(0)
+    queue.close()
+    with pytest.raises(HubError):
+        await queued
+    assert queue.dropped == 1
+    await first
+
+
+async def test_device_in_flight_does_not_spin():
+    post = Recorder(delay=0.2)
+    queue = CommandQueue(post)
+    flushes = 0
+    flush = queue._flush
+
+    def counting_flush():
+        nonlocal flushes
+        flushes += 1
+        return flush()
+
+    queue._flush = counting_flush
+    first = asyncio.ensure_future(queue.submit("a", "setLevel", [10]))
+    await asyncio.sleep(0.01)
+    second = asyncio.ensure_future(queue.submit("a", "setLevel", [20]))
+    await asyncio.gather(first, second)
+    assert flushes == 2
+    assert post.batches == [[("a", "setLevel", [10])], [("a", "setLevel", [20])]]
+
+
+async def test_failed_post_fails_callers():
+    async def post(commands):
+        raise HubError("down")
+
+    queue = CommandQueue(post)
+    with pytest.raises(HubError):
+        await queue.submit("a", "on")
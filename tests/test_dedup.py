@@ -0,0 +1,38 @@
+"""Tests of the de-duplication of events received on LAN and from cloud."""
+import time
+
+from custom_components.lan_smartthings.const import PATH_CLOUD, PATH_LAN
+from custom_components.lan_smartthings.events import EventDeduplicator
+from custom_components.lan_smartthings.metrics import HubMetrics
+
+
+def test_duplicate_is_seen_and_race_recorded():
+    metrics = HubMetrics()
+    dedup = EventDeduplicator(metrics=metrics)
+    assert not dedup.seen("e1", PATH_LAN)
+    assert dedup.seen("e1", PATH_CLOUD)
+    assert metrics.race_wins[PATH_LAN] == 1
+    assert metrics.race_lag.count == 1
+
+
+def test_duplicate_on_same_path_is_no_race():
+    metrics = HubMetrics()
+    dedup = EventDeduplicator(metrics=metrics)
+    dedup.seen("e1", PATH_LAN)
+    assert dedup.seen("e1", PATH_LAN)
+    assert metrics.race_wins == {PATH_LAN: 0, PATH_CLOUD: 0}
+
+
+def test_dedup_forgets_after_window():
+    dedup = EventDeduplicator(window=0.01)
+    dedup.seen("e1")
+    time.sleep(0.02)
+    assert not dedup.seen("e1")
+
+
+def test_dedup_is_bounded():
+    dedup = EventDeduplicator(max_size=2)
+    for event_id in ("e1", "e2", "e3"):
+        dedup.seen(event_id)
+    assert len(dedup) == 2
+    assert not dedup.seen("e1")
@@ -0,0 +1,20 @@
+"""Tests of dropping events overtaken by newer ones, LAN and cloud."""
+from custom_components.lan_smartthings.events import EventOrder, cloud_event_time
+from custom_components.lan_smartthings.metrics import HubMetrics
+
+
+def test_older_event_is_stale():
+    metrics = HubMetrics()
+    order = EventOrder(metrics=metrics)
+    assert not order.stale("d1", "switch", 2000)
+    assert order.stale("d1", "switch", 1000)
+    assert not order.stale("d1", "switch", 2000)
+    assert not order.stale("d1", "level", 1000)
+    assert not order.stale("d1", "switch", None)
+    assert metrics.stale_events == 1
+    assert len(order) == 2
+
+
+def test_cloud_event_time():
+    assert cloud_event_time({"eventTime": "2021-08-12T10:00:00.250Z"}) == 1628762400250
+    assert cloud_event_time({}) is None
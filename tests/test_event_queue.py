@@ -0,0 +1,40 @@
+"""Tests of the queue between the LAN webhook and event dispatch."""
+import asyncio
+from typing import List
+
+import pytest
+
+from custom_components.lan_smartthings.events import EventQueue, LanEvent
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_queue_hands_events_to_handler(lan_event):
+    handled: List[List[LanEvent]] = []
+    queue = EventQueue(handled.append)
+    queue.start()
+    events = [lan_event(), lan_event("d2")]
+    queue.put(events)
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    assert [evt for batch in handled for evt in batch] == events
+    await queue.stop()
+
+
+async def test_full_queue_keeps_latest_state_of_each_attribute(lan_event):
+    handled: List[List[LanEvent]] = []
+    queue = EventQueue(handled.append, max_size=2)
+    unrelated = lan_event("d2", "switch", "off")
+    queue.put([lan_event("d1", "level", 10), unrelated])
+    queue.put([lan_event("d1", "level", 20), lan_event("d1", "button", "pushed")])
+    press = lan_event("d1", "button", "pushed")
+    queue.put([lan_event("d1", "level", 30), press])
+    queue.start()
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    applied = [(evt.device_id, evt.attribute, evt.value) for batch in handled for evt in batch]
+    assert ("d2", "switch", "off") in applied
+    assert [value for _, attribute, value in applied if attribute == "level"] == [20, 30]
+    assert sum(1 for _, attribute, _ in applied if attribute == "button") == 2
+    assert queue.dropped == 1
+    await queue.stop()
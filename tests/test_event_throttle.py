@@ -0,0 +1,67 @@
+"""Tests of the LAN event throttle."""
+import asyncio
+from typing import List
+
+import pytest
+
+from custom_components.lan_smartthings.events import LanEvent
+from custom_components.lan_smartthings.throttle import EventThrottle, ThrottleRule
+
+pytestmark = pytest.mark.asyncio
+
+
+def make_throttle(flushed: List[LanEvent], **rule) -> EventThrottle:
+    return EventThrottle(flushed.extend, {(None, "power"): ThrottleRule(**rule)})
+
+
+async def test_unthrottled_attributes_pass(lan_event):
+    throttle = make_throttle([], min_interval=60)
+    events = [lan_event(attribute="switch"), lan_event(attribute="level", value=10)]
+    assert throttle.filter(events) is events
+
+
+async def test_interval_suppresses_and_flushes_latest(lan_event):
+    flushed: List[LanEvent] = []
+    throttle = make_throttle(flushed, min_interval=0.05)
+    first = lan_event(attribute="power", value=1)
+    assert throttle.filter([first]) == [first]
+    last = lan_event(attribute="power", value=3)
+    assert throttle.filter([lan_event(attribute="power", value=2), last]) == []
+    assert throttle.suppressed == {"power": 2}
+    await asyncio.sleep(0.1)
+    assert flushed == [last]
+    assert throttle.flushed == 1
+    throttle.close()
+
+
+async def test_small_changes_are_suppressed(lan_event):
+    throttle = make_throttle([], delta=1.0)
+    assert throttle.filter([lan_event(attribute="power", value=10)])
+    assert not throttle.filter([lan_event(attribute="power", value=10.5)])
+    assert throttle.filter([lan_event(attribute="power", value=11)])
+    assert throttle.suppressed == {"power": 1}
+
+
+async def test_trailing_event_needs_to_move(lan_event):
+    flushed: List[LanEvent] = []
+    throttle = make_throttle(flushed, min_interval=0.05, delta=1.0)
+    throttle.filter([lan_event(attribute="power", value=10)])
+    throttle.filter([lan_event(attribute="power", value=10.5)])
+    await asyncio.sleep(0.1)
+    assert flushed == []
+    throttle.close()
+
+
+async def test_state_changes_pass(lan_event):
+    throttle = make_throttle([], min_interval=60, pass_state_changes=True)
+    assert throttle.filter([lan_event(attribute="power", value=1)])
+    assert throttle.filter([lan_event(attribute="power", value=2)])
+    assert not throttle.filter([lan_event(attribute="power", value=3, stateChange=False)])
+    throttle.close()
+
+
+async def test_devices_are_throttled_apart(lan_event):
+    throttle = make_throttle([], min_interval=60)
+    assert throttle.filter([lan_event("d1", "power", 1)])
+    assert throttle.filter([lan_event("d2", "power", 1)])
+    throttle.close()
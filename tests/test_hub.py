@@ -0,0 +1,252 @@
+"""Tests of the Hub against a stand-in of the SmartApp."""
+import asyncio
+from types import SimpleNamespace
+from typing import Dict, List
+
+import pytest
+from aiohttp.client_exceptions import ClientPayloadError
+from homeassistant.const import EVENT_HOMEASSISTANT_CLOSE
+from pysmartapp.const import EVENT_TYPE_DEVICE
+from pysmartapp.event import EventRequest
+
+from custom_components.lan_smartthings import hub as hub_module
+from custom_components.lan_smartthings.const import PATH_CLOUD, PATH_LAN
+from custom_components.lan_smartthings.hub import Hub, HubInfo, HubRegistry
+from custom_components.lan_smartthings.metrics import HubMetrics
+from custom_components.lan_smartthings.retry import (BREAKER_CLOSED, BREAKER_OPEN, CircuitBreaker, HubError,
+                                                     HubUnavailable)
+
+pytestmark = pytest.mark.asyncio
+
+
+class Request():
+
+    def __init__(self, body) -> None:
+        self._body = body
+
+    async def json(self):
+        return self._body
+
+
+class SmartApp():
+    '''Answers one instance like smartapp.groovy, only while it holds its subscription'''
+
+    def __init__(self, hub: Hub) -> None:
+        self.hub = hub
+        self.subscribed = False
+        self.registrations = 0
+        self.errors: Dict[str, List[Exception]] = {}  # raised by the next requests of an action
+
+    def reply(self, body):
+        if self.subscribed:
+            asyncio.create_task(self.hub.webhook_handler(self.hub.hass, "", Request(body)))
+
+    async def post(self, action, data=None, *, attempts=1):
+        errors = self.errors.get(action)
+        if errors:
+            raise errors.pop(0)
+        if action == "register":
+            self.subscribed = True
+            self.registrations += 1
+            self.reply({"accessToken": "token", "devices": ["d1"]})
+        elif action == "ping":
+            self.reply({"pong": data["id"]})
+
+
+class Broker():
+    '''Records the events of the cloud requests passed on'''
+
+    def __init__(self) -> None:
+        self.devices = {}
+        self.received: List[List[str]] = []
+
+    async def _event_handler(self, req, resp, app):
+        self.received.append([evt.event_id for evt in req.events])
+
+
+def cloud_request(installed_app_id: str, *event_ids: str) -> EventRequest:
+    return EventRequest({
+        "lifecycle": "EVENT",
+        "executionId": "",
+        "locale": "",
+        "version": "",
+        "eventData": {
+            "authToken": "",
+            "installedApp": {"installedAppId": installed_app_id, "locationId": "l1", "config": {}},
+            "events": [{"eventType": EVENT_TYPE_DEVICE, "eventTime": "2021-08-01T00:00:00.000Z",
+                        "deviceEvent": {"subscriptionName": "", "eventId": event_id, "locationId": "l1",
+                                        "deviceId": "d1", "componentId": "main", "capability": "switch",
+                                        "attribute": "switch", "value": "on", "valueType": "string",
+                                        "stateChange": True}}
+                       for event_id in event_ids],
+        },
+    })
+
+
+class Session():
+    '''Fails or answers hub requests in turn, None answers, a future holds the answer back'''
+
+    def __init__(self, *outcomes) -> None:
+        self.outcomes = list(outcomes)
+
+    def request(self, method, url, **kwargs):
+        return Response(self.outcomes.pop(0))
+
+
+class Response():
+
+    def __init__(self, outcome) -> None:
+        self.outcome = outcome
+
+    async def __aenter__(self):
+        if isinstance(self.outcome, asyncio.Future):
+            await self.outcome
+        elif self.outcome is not None:
+            raise self.outcome
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def read(self):
+        return b""
+
+
+async def post(session: Session, breaker: CircuitBreaker, attempts: int = 1):
+    await Hub._post(session=session, breaker=breaker, metrics=HubMetrics(),
+                    url="http://127.0.0.1:39500", action="command", attempts=attempts)
+
+
+async def wait_until(predicate, timeout: float = 5.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not predicate():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+
+@pytest.fixture
+def smartapp(hass, monkeypatch):
+    '''SmartApp answering a hub that is not started yet, health checks and retries are fast'''
+    monkeypatch.setattr(hub_module, "HEALTH_CHECK_INTERVAL", 0.02)
+    monkeypatch.setattr(hub_module, "HEALTH_PING_TIMEOUT", 0.05)
+    monkeypatch.setattr(hub_module, "HEALTH_FAILURE_THRESHOLD", 2)
+    monkeypatch.setattr(hub_module, "backoff_delay", lambda attempt, **kwargs: 0.01)
+    hass.http = SimpleNamespace(server_port=8123)
+    info = HubInfo(hass=hass, lan_webhook_id="lan", hub_url="http://127.0.0.1:39500", hub_ip="127.0.0.1",
+                   hub_id="h1", location_id="l1", targeturl_base="https://localhost/relay?access_token=",
+                   cloud_webhook_id="cloud", access_token="", instance_id="i1")
+    hub = Hub(hass, info=info)
+    smartapp = SmartApp(hub)
+    monkeypatch.setattr(hub, "post", smartapp.post)
+
+    async def same_address():
+        return False
+    monkeypatch.setattr(hub, "_follow_hub_address", same_address)
+    return smartapp
+
+
+@pytest.fixture
+async def started_hub(smartapp):
+    hub = smartapp.hub
+    hub.start(SimpleNamespace(devices={}), "app", HubRegistry())
+    await wait_until(lambda: hub.lan_ready)
+    yield hub, smartapp
+    await hub.stop()
+
+
+async def test_expired_instance_registers_again(started_hub):
+    hub, smartapp = started_hub
+    # the SmartApp expired the subscription, it no longer answers pings
+    smartapp.subscribed = False
+    await wait_until(lambda: smartapp.registrations == 2)
+    await wait_until(lambda: hub.lan_ready)
+    assert hub.metrics.ping_failures >= 2
+
+
+async def test_registration_retries_unexpected_errors(smartapp):
+    hub = smartapp.hub
+    smartapp.errors["register"] = [RuntimeError("unexpected")]
+    hub.start(SimpleNamespace(devices={}), "app", HubRegistry())
+    await wait_until(lambda: hub.lan_ready)
+    assert smartapp.registrations == 1
+    assert hub.metrics.ping_failures == 0  # not recovered by the health monitor
+    await hub.stop()
+
+
+async def test_health_monitor_survives_unexpected_errors(started_hub):
+    hub, smartapp = started_hub
+    smartapp.errors["ping"] = [RuntimeError("unexpected")]
+    await wait_until(lambda: not smartapp.errors["ping"])
+    await wait_until(lambda: hub.metrics.ping_rtt.count > 0)
+    assert hub.lan_ready
+
+
+async def test_probe_failing_otherwise_reopens_breaker():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    breaker.record_failure()
+    with pytest.raises(ValueError):
+        await post(Session(ValueError("unexpected")), breaker)
+    assert breaker.state == BREAKER_OPEN
+    # the next probe is let through
+    await post(Session(None), breaker)
+    assert breaker.state == BREAKER_CLOSED
+
+
+async def test_client_errors_are_hub_errors():
+    breaker = CircuitBreaker(failure_threshold=1)
+    with pytest.raises(HubError) as raised:
+        await post(Session(ClientPayloadError("truncated")), breaker, attempts=3)
+    assert not isinstance(raised.value, HubUnavailable)
+    assert breaker.state == BREAKER_OPEN
+
+
+async def test_cancelled_request_keeps_probe_of_another_request():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    in_flight = asyncio.create_task(post(Session(asyncio.get_running_loop().create_future()), breaker))
+    await asyncio.sleep(0)
+    breaker.record_failure()  # another request failed meanwhile
+    breaker.before_request()  # and the next one probes the hub
+    in_flight.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await in_flight
+    with pytest.raises(HubUnavailable):
+        breaker.before_request()
+
+
+async def test_cloud_events_of_other_installed_apps_are_left_alone(smartapp):
+    hub, broker = smartapp.hub, Broker()
+    hub.start(broker, "app", HubRegistry())
+    await hub.cloud_event_handler(cloud_request("other", "e1"), None, None)
+    assert broker.received == []
+    assert hub.metrics.events_received[PATH_CLOUD] == 0
+    # not taken for a duplicate when it comes for this location
+    await hub.cloud_event_handler(cloud_request("app", "e1"), None, None)
+    assert broker.received == [["e1"]]
+    await hub.stop()
+
+
+async def test_cloud_duplicates_are_dropped_from_a_copy(smartapp):
+    hub, broker = smartapp.hub, Broker()
+    hub.start(broker, "app", HubRegistry())
+    hub._seen_events.seen("e1", PATH_LAN)
+    req = cloud_request("app", "e1", "e2")
+    await hub.cloud_event_handler(req, None, None)
+    assert broker.received == [["e2"]]
+    assert [evt.event_id for evt in req.events] == ["e1", "e2"]
+    await hub.stop()
+
+
+async def test_session_is_detached_when_home_assistant_closes(hass):
+    info = HubInfo(hass=hass, lan_webhook_id="lan", hub_url="http://127.0.0.1:39500", hub_ip="127.0.0.1",
+                   hub_id="h1", location_id="l1", targeturl_base="https://localhost/relay?access_token=",
+                   cloud_webhook_id="cloud", access_token="", instance_id="i1")
+    hub = Hub(hass, info=info)
+    session = hub._get_session()
+    assert hub._get_session() is session
+    hass.bus.async_fire(EVENT_HOMEASSISTANT_CLOSE)
+    await hass.async_block_till_done()
+    assert session.closed
+    # a session made later is closed by the hub alone
+    hub._get_session()
+    await hub.close()
+    assert EVENT_HOMEASSISTANT_CLOSE not in hass.bus.async_listeners()
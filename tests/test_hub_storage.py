@@ -0,0 +1,80 @@
+"""Tests of the hub records kept per location."""
+from types import SimpleNamespace
+
+import pytest
+from homeassistant.helpers.storage import Store
+
+from custom_components.lan_smartthings.const import (CONF_CLOUD_CALLBACK_WEBHOOK_ID, CONF_HUB_ACCESS_TOKEN,
+                                                      CONF_HUB_IP, CONF_HUB_URL, CONF_INSTANCE_ID,
+                                                      CONF_LAN_CALLBACK_WEBHOOK_ID, CONF_LOCATION_ID,
+                                                      CONF_TARGET_URL_BASE, STORAGE_KEY, STORAGE_VERSION)
+from custom_components.lan_smartthings.hub import Hub, HubInfo
+from custom_components.lan_smartthings.retry import HubError
+
+pytestmark = pytest.mark.asyncio
+
+
+def configure(hass, *location_ids):
+    '''Config entries of the locations'''
+    entries = [SimpleNamespace(data={CONF_LOCATION_ID: location_id}) for location_id in location_ids]
+    hass.config_entries = SimpleNamespace(async_entries=lambda domain: entries)
+
+
+async def save_legacy_hub(hass):
+    '''The single hub record of earlier versions'''
+    await Store(hass, STORAGE_VERSION, STORAGE_KEY).async_save({
+        CONF_LAN_CALLBACK_WEBHOOK_ID: "lan",
+        CONF_HUB_ACCESS_TOKEN: "token",
+        CONF_CLOUD_CALLBACK_WEBHOOK_ID: "cloud",
+        CONF_HUB_URL: "http://127.0.0.1:39500",
+        CONF_HUB_IP: "127.0.0.1",
+        CONF_TARGET_URL_BASE: "https://localhost/relay?access_token=",
+        CONF_INSTANCE_ID: "i1",
+    })
+
+
+def app(*hub_ids):
+    hubs = [{"id": hub_id, "data": {"localIP": "127.0.0.1", "localSrvPortTCP": 39500}} for hub_id in hub_ids]
+    return {"id": "app", "location": {"id": "l1", "hubs": hubs}}
+
+
+async def test_legacy_hub_moves_to_its_only_location(hass):
+    configure(hass, "l1")
+    await save_legacy_hub(hass)
+    infos = await HubInfo.load_all(hass, "l1")
+    assert [(info._location_id, info._access_token) for info in infos] == [("l1", "token")]
+    assert [info._hub_url for info in await HubInfo.load_all(hass, "l1")] == ["http://127.0.0.1:39500"]
+
+
+async def test_legacy_hub_stays_when_its_location_is_unknown(hass):
+    configure(hass, "l1", "l2")
+    await save_legacy_hub(hass)
+    assert await HubInfo.load_all(hass, "l2") == []
+    assert CONF_LAN_CALLBACK_WEBHOOK_ID in await HubInfo.load_shared(hass)
+
+
+async def test_failed_setup_keeps_saved_hubs(hass, monkeypatch):
+    async def fail(self):
+        raise HubError("not answering")
+    monkeypatch.setattr(Hub, "register", fail)
+    saved = HubInfo(hass=hass, lan_webhook_id="lan", hub_url="http://127.0.0.1:39500", hub_ip="127.0.0.1",
+                    hub_id="h0", location_id="l1", targeturl_base="https://localhost/relay?access_token=",
+                    cloud_webhook_id="cloud", access_token="token", instance_id="i1")
+    await saved.save()
+    with pytest.raises(HubError):
+        await Hub.setup(hass=hass, app=app("h1"), servername="graph")
+    assert [info._hub_id for info in await HubInfo.load_all(hass, "l1")] == ["h0"]
+
+
+async def test_setup_replaces_saved_hubs(hass, monkeypatch):
+    async def register(self):
+        self._info._access_token = "token"
+    monkeypatch.setattr(Hub, "register", register)
+    monkeypatch.setattr(Hub, "patch_methods", lambda self: None)
+    saved = HubInfo(hass=hass, lan_webhook_id="lan", hub_url="http://127.0.0.1:39500", hub_ip="127.0.0.1",
+                    hub_id="h0", location_id="l1", targeturl_base="https://localhost/relay?access_token=",
+                    cloud_webhook_id="cloud", access_token="token", instance_id="i1")
+    await saved.save()
+    hub = await Hub.setup(hass=hass, app=app("h1"), servername="graph")
+    assert hub.hub_id == "h1"
+    assert [info._hub_id for info in await HubInfo.load_all(hass, "l1")] == ["h1"]
@@ -0,0 +1,81 @@
+"""Tests of optimistic command results."""
+import asyncio
+from typing import List, Set
+
+import pytest
+from pysmartthings import DeviceEntity
+
+from custom_components.lan_smartthings.optimistic import OptimisticUpdates
+
+pytestmark = pytest.mark.asyncio
+
+
+def make_device(switch: str = "off", level: int = 20) -> DeviceEntity:
+    device = DeviceEntity(None, {
+        "deviceId": "d1",
+        "name": "light",
+        "label": "Light",
+        "locationId": "l1",
+        "type": "DTH",
+        "components": [{"id": "main", "capabilities": [{"id": "switch"}, {"id": "switchLevel"}]}],
+        "dth": {"deviceTypeId": "", "deviceTypeName": "", "deviceNetworkType": ""},
+    })
+    device.status.apply_attribute_update("main", "switch", "switch", switch)
+    device.status.apply_attribute_update("main", "switchLevel", "level", level)
+    return device
+
+
+async def test_apply_and_confirm():
+    notified: List[Set[str]] = []
+    optimistic = OptimisticUpdates(notified.append, timeout=0.05)
+    device = make_device()
+    assert optimistic.apply(device, "on", []) == ("d1", "switch")
+    assert device.status.switch
+    assert notified == [{"d1"}]
+    optimistic.confirm("d1", "switch")
+    await asyncio.sleep(0.1)
+    assert device.status.switch
+    assert (optimistic.applied, optimistic.confirmed, optimistic.rolled_back) == (1, 1, 0)
+    assert len(optimistic) == 0
+
+
+async def test_unconfirmed_command_rolls_back():
+    notified: List[Set[str]] = []
+    optimistic = OptimisticUpdates(notified.append, timeout=0.05)
+    device = make_device()
+    optimistic.apply(device, "setLevel", [80])
+    assert device.status.level == 80
+    await asyncio.sleep(0.1)
+    assert device.status.level == 20
+    assert optimistic.rolled_back == 1
+    assert notified == [{"d1"}, {"d1"}]
+
+
+async def test_rollback_keeps_the_first_previous_value():
+    optimistic = OptimisticUpdates(lambda devices: None)
+    device = make_device()
+    optimistic.apply(device, "setLevel", [50])
+    key = optimistic.apply(device, "setLevel", [80])
+    optimistic.rollback(key)
+    assert device.status.level == 20
+    optimistic.close()
+
+
+async def test_rollback_leaves_a_newer_value():
+    optimistic = OptimisticUpdates(lambda devices: None)
+    device = make_device()
+    key = optimistic.apply(device, "setLevel", [80])
+    device.status.apply_attribute_update("main", "switchLevel", "level", 60)
+    optimistic.rollback(key)
+    assert device.status.level == 60
+    assert optimistic.rolled_back == 0
+
+
+async def test_nothing_to_apply():
+    optimistic = OptimisticUpdates(lambda devices: None)
+    device = make_device(switch="on")
+    assert optimistic.apply(device, "on", []) is None
+    assert optimistic.apply(device, "refresh", []) is None
+    assert optimistic.apply(None, "off", []) is None
+    assert optimistic.apply(device, "setLevel", []) is None
+    assert optimistic.applied == 0